@@ -1,13 +1,23 @@
-import numpy as np
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
+import math
 import openai
-from jira import JIRA
 import requests
+from response_cache import response_cache, is_bypass
+from prompt_pipeline import PROMPT_ROUTES, ROUTES_BY_PATH, run_route, stream_route, similar, prefetcher, summariser, near_duplicates
+from model_router import router
+from funnel_pipeline import PipelineError, parse_stages, run_pipeline, pipeline_events
+from job_queue import JobError, job_queue
+from jira_export import JiraExportError, jira_exporter
+from artefact_store import ArtefactError, artefact_store
+from upstream_client import upstream, UpstreamError
+from single_flight import single_flight
+from rate_limiter import scheduler
+from metrics import metrics
+from salary_model import InvalidRecordsError, parse_records, predict_salaries, batcher, model_info, open_csv, score_csv
+from micro_batcher import BatchQueueFullError
 
 # Load the .env file
 load_dotenv()
@@ -15,435 +25,272 @@ load_dotenv()
 # Get the secret key from the environment variables
 openai.api_key = os.getenv("SECRET_KEY")
 
+# Point the client somewhere else, e.g. the local fake API used by the benchmarks
+openai.api_base = os.getenv("OPENAI_API_BASE", openai.api_base)
+
 # Define the Flask app
 app = Flask(__name__)
 cors = CORS(app)
 
+# Start timing every request that matched a route
+@app.before_request
+def start_request_metrics():
+    if request.url_rule is not None:
+        g.metrics_token = metrics.start_request(request.url_rule.rule)
+
+# Tell the client whether the completion came from the cache
+@app.after_request
+def add_cache_header(response):
+    cache_status = g.get('cache_status')
+    if cache_status:
+        response.headers['X-Cache'] = cache_status
+    return response
+
+# Record the request's latency and status (streamed responses stop the clock
+# once the headers are sent)
+@app.after_request
+def finish_request_metrics(response):
+    metrics_token = g.pop('metrics_token', None)
+    if metrics_token is not None:
+        metrics.finish_request(metrics_token, response.status_code)
+    return response
+
+# Prometheus-style metrics for this worker
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Route for checking the response cache hit/miss counters
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    stats = response_cache.stats()
+    stats['single_flight'] = single_flight.stats()
+    stats['prefetch'] = prefetcher.stats()
+    stats['context_summaries'] = summariser.stats()
+    stats['near_duplicates'] = near_duplicates.stats()
+    return jsonify(stats)
+
+# Route for operators to see which model each route is using and why
+@app.route('/model-routes', methods=['GET'])
+def model_routes():
+    return jsonify(router.table(PROMPT_ROUTES))
+
+# Route for checking the OpenAI connection pool, retries, circuit breaker and quota
+@app.route('/upstream-stats', methods=['GET'])
+def upstream_stats():
+    stats = upstream.stats()
+    stats['rate_limit'] = scheduler.stats()
+    return jsonify(stats)
+
+# Answer with 429/502/503 instead of a 500 when the OpenAI (or Jira) API call fails or is shed
+@app.errorhandler(UpstreamError)
+def upstream_error(e):
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(int(math.ceil(e.retry_after)))
+    return response
+
 # NEW USER FLOW
 
-# Route for predicting with OpenAI integration
-@app.route('/openai-predict', methods=['POST'])
-def openai_predict():
-    # Retrieve the input data from the request
-    input_text = request.json['inputText']
-
-    # Prepend the desired string to the input text
-    prompt_string = "List 5 high quality problem statements based on the following problem, in a user story format from the agile software development framework. Make each item in the format As a <something>, I want to <do something>, so that <some outcome>. No line breaks. The problem is:"
-    input_text = prompt_string + " " + input_text
-
-    # Make the request to the OpenAI API using the openai.ChatCompletion.create() method
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "user", "content": input_text},
-        ],
-        max_tokens=200
-    )
-
-    # Check for errors in the response
-    if 'choices' in response and len(response['choices']) > 0:
-        # Extract the predicted text from the API response
-        predicted_text = response['choices'][0]['message']['content'].strip()
-
-        # Split the predicted text into individual items if it's a list
-        predicted_items = predicted_text.split('\n')
+# Build the view function for one entry in the prompt registry
+def make_prompt_view(route):
+    def prompt_view():
+        # Retrieve the input data from the request
+        with metrics.timed('parse_seconds', route.path):
+            input_text = request.json['inputText']
+            funnel_id = request.json.get('funnelId')
+
+        # Stages of a saved funnel are kept (and reused) in the artefact store
+        if funnel_id is not None:
+            try:
+                payload, g.cache_status = artefact_store.run_stage(funnel_id, route, input_text, is_bypass(request.headers))
+            except ArtefactError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            payload, g.cache_status = run_route(route, input_text, is_bypass(request.headers))
 
         # Return the predicted items as JSON response
-        return jsonify({'predicted_items': predicted_items})
-    else:
-        # Handle the situation where 'choices' is not in the response
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-
-@app.route('/openai-solution', methods=['POST'])
-def openai_solution():
-    input_text = request.json['inputText']
-
-    prompt_string = "Given the following user story, generate 5 high-quality acceptance criteria for agile software development. Each criterion should be no more than 100 characters long, in a list format. Only include the list in your response, no other text. The user story is:"
-    problem_statement = prompt_string + " " + input_text
-
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-
-    # Check for errors in the response
-    if 'choices' in response and len(response['choices']) > 0:
-        # Extract the predicted text from the API response
-        predicted_text = response['choices'][0]['message']['content'].strip()
-
-        # Split the predicted text into individual solutions if it's a list
-        predicted_solutions = predicted_text.split('\n')
-
-        # Return the predicted solutions as JSON response
-        return jsonify({'predicted_items': predicted_solutions})
-    else:
-        # Handle the situation where 'choices' is not in the response
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/tasks', methods=['POST'])
-def tasks():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Given the following acceptance criteria and technical requirements, provide a list of 10 detailed programming tasks that would be needed to build the digital solution. Each item should be no more than 100 characters long, in a list format. Only include the list in your response, no other text: "
-    problem_statement = prompt_string + " " + input_text
-
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-
-    # Check for errors in the response
-    if 'choices' in response and len(response['choices']) > 0:
-        # Extract the predicted text from the API response
-        predicted_text = response['choices'][0]['message']['content'].strip()
-
-        # Split the predicted text into individual tasks if it's a list
-        predicted_tasks = predicted_text.split('\n')
-
-        # Return the predicted tasks as JSON response
-        return jsonify({'predicted_items': predicted_tasks})
-    else:
-        # Handle the situation where 'choices' is not in the response
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/targetCustomer', methods=['POST'])
-def targetCustomer():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the following User Story, Acceptance Criteria, Technical Requirement, and Tasks, provide me with the most likely options of my who my target customer is. Each item should be no more than 100 characters long, in a list format. Only include the list in your response, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-
-@app.route('/dataElements', methods=['POST'])
-def dataElements():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Given the following final problem statement, acceptance criteria, and target market, list for me the 5 important data metrics to consider for my feature. Each item should be no more than 100 characters long, in a list format. Only include the list in your response, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-
-@app.route('/hypothesis', methods=['POST'])
-def hypothesis():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the finalProblemStatement, the Data Elements, the acceptanceCriteria and the targetCustomer, give me 5 potential solution hypotheses for this feature. Incorporate one of the Metrics in the format: 'X amount / percent of Target market / persona can do something / specific metric of the solution. No line breaks): "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/marketing-material', methods=['POST'])
-def marketingMaterial():
-    input_text = request.json['inputText']
-
-    # Preprocess input_text to split it into individual sentences
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the target customer, market size, and solution hypotheses, provide me a list of potential marketing materials for this feature. Example 1: 'Blog: <title>', Example 2: 'Email: <Subject Line>, Example 3: 'Social Post: <Summary>. Each item should be no more than 200 characters long, in a list format. Only include the list in your response, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/feature-name', methods=['POST'])
-def featureName():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the user story, target customer, and solution hypothesis, provide me a list of potential Feature Names for this feature. Each item should be no more than 4 words long, capitalised, in a list format. Only include the list in your response, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/whats-next', methods=['POST'])
-def whatsNext():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "This is what i have so far in the product management process for my new feature, what should i do next? Provide this in list format, only provide the list items, no other commentary: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/feature-assess', methods=['POST'])
-def FeatureAssess():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "This is what i have so far for my new feature. Please critically assess the feature, tell me the top 2 most important Strengths, 2 Weaknessess, 2 Threats and 2 Opportunities. 100 characters for each item maximum: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-
-@app.route('/task-list', methods=['POST'])
-def TaskList():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Given the following activity, generate me a 5 item task list of how I can get this activity done:"
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-
-@app.route('/social-post', methods=['POST'])
-def SocialPost():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the target customer, market size, and solution hypotheses, provide me with a social media post content I could use to communicate the feature. Make it 400 characters maximum. Only include the post content in your response, no other text:"
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/blog-post', methods=['POST'])
-def BlogPost():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the target customer, market size, and solution hypotheses, provide me with a blog post I could use to communicate the feature. Make it 300 words maximum. Make this all return on 1 paragraph. Only include the post content in your response, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=600
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-
-@app.route('/email-post', methods=['POST'])
-def EmailPost():
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the target customer, market size, and solution hypotheses, provide me with an email content I could use to communicate the feature. Make it 800 characters maximum. Make this all return in 1 single paragraph. Do not include the lines: 'Subject line, dear xyz, with regards, [your name] in the response, Only include the email content in your response, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",  # Assuming the model's name
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=200
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        predicted_requirements = predicted_text.split('\n')
-        return jsonify({'predicted_items': predicted_requirements})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/frontend-code', methods=['POST'])
-def FrontendCode():   
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the given user story, tasks, acceptance criteria, and solution, provide me with a piece of React code that is useable for the frontend of this feature. This should be formatted like React JSX code. Only return the code, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=1000
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        return jsonify({'predicted_items': predicted_text})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
-    
-@app.route('/backend-code', methods=['POST'])
-def BackendCode():   
-    input_text = request.json['inputText']
-
-    input_text_list = input_text.split(', ')
-    input_text = ' '.join(input_text_list)
-
-    prompt_string = "Based on the given user story, tasks, acceptance criteria, and solution, provide me with a piece of Python code that is useable for the frontend of this feature. This should be formatted like Python code. Only return the code, no other text: "
-    problem_statement = prompt_string + " " + input_text
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "user", "content": problem_statement},
-        ],
-        max_tokens=1000
-    )
-    if 'choices' in response and len(response['choices']) > 0:
-        predicted_text = response['choices'][0]['message']['content'].strip()
-        return jsonify({'predicted_items': predicted_text})
-    else:
-        print("No 'choices' in API response")
-        print(response)
-        return jsonify({'error': "No 'choices' in API response"})
+        with metrics.timed('serialize_seconds', route.path):
+            return jsonify(payload)
+
+    prompt_view.__name__ = route.endpoint
+    return prompt_view
+
+# Build the Server-Sent Events view for a long-form route
+def make_stream_view(route):
+    def stream_view():
+        with metrics.timed('parse_seconds', route.stream_path):
+            input_text = request.json['inputText']
+
+        events, g.cache_status = stream_route(route, input_text, is_bypass(request.headers))
+
+        # Relay tokens to the client as they arrive from the API
+        return Response(stream_with_context(events), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    stream_view.__name__ = route.endpoint + '_stream'
+    return stream_view
+
+# Register every route in the prompt registry (see prompt_pipeline.py)
+for prompt_route in PROMPT_ROUTES:
+    app.add_url_rule(prompt_route.path, prompt_route.endpoint, make_prompt_view(prompt_route), methods=['POST'])
+    if prompt_route.stream:
+        app.add_url_rule(prompt_route.stream_path, prompt_route.endpoint + '_stream', make_stream_view(prompt_route), methods=['POST'])
+
+# Route for offering an earlier completion before generating: takes
+# {route, inputText} and returns the completion of the most similar earlier
+# input to that route (see near_duplicates.py), or 404 if there is none
+@app.route('/similar', methods=['POST'])
+def similar_completion():
+    body = request.get_json(silent=True) or {}
+    route = ROUTES_BY_PATH.get(body.get('route'))
+    if route is None or not isinstance(body.get('inputText'), str):
+        return jsonify({'error': "Request body must be JSON with a prompt 'route' and an 'inputText' field"}), 400
+
+    match = similar(route, body['inputText'])
+    if match is None:
+        return jsonify({'error': 'No similar earlier input'}), 404
+    similarity, payload = match
+    return jsonify(dict(payload, similarity=similarity))
+
+# Route for running several funnel stages in one request. Independent stages run
+# in parallel and downstream inputText placeholders are filled with upstream results.
+@app.route('/pipeline', methods=['POST'])
+def pipeline():
+    try:
+        stages = parse_stages(request.json)
+    except PipelineError as e:
+        return jsonify({'error': str(e)}), 400
+
+    bypass_cache = is_bypass(request.headers)
+
+    # Optionally stream each stage's result as soon as it is ready
+    if request.json.get('stream'):
+        return Response(stream_with_context(pipeline_events(stages, bypass_cache)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    results = dict(run_pipeline(stages, bypass_cache))
+    return jsonify({'results': results})
+
+# Route for reloading or sharing a funnel: every stage saved under its
+# funnelId, with its output and the tokens it took, in one indexed read
+@app.route('/funnels/<funnel_id>', methods=['GET'])
+def funnel(funnel_id):
+    stages = artefact_store.funnel(funnel_id)
+    if not stages:
+        return jsonify({'error': 'Unknown funnel'}), 404
+    return jsonify({'funnel_id': funnel_id, 'stages': stages})
+
+# Route for checking how often stages are answered from the artefact store
+@app.route('/artefact-stats', methods=['GET'])
+def artefact_stats():
+    return jsonify(artefact_store.stats())
+
+# Start the job workers now, so jobs queued before a restart run without waiting for a new one
+job_queue.start()
+
+# Route for queueing a long generation (e.g. /frontend-code, /blog-post) that
+# would run past the gunicorn worker timeout. Takes {route, inputText} and
+# answers straight away with a job ID; identical pending jobs share one ID.
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    body = request.get_json(silent=True) or {}
+    try:
+        job = job_queue.submit(body.get('route'), body.get('inputText'), is_bypass(request.headers))
+    except JobError as e:
+        return jsonify({'error': str(e)}), 400
+
+    job['poll'] = '/jobs/' + job['job_id']
+    return jsonify(job), 202, {'Location': job['poll']}
+
+# Route for collecting a job's result. ?wait=N long-polls for up to N seconds.
+# Finished jobs are kept for JOB_TTL_SECONDS, then answer 404 like unknown IDs.
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    wait = request.args.get('wait', type=float)
+    job = job_queue.wait(job_id, wait) if wait else job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job)
+
+# Route for checking the job queue depth
+@app.route('/job-stats', methods=['GET'])
+def job_stats():
+    return jsonify(job_queue.stats())
+
+# JIRA EXPORT
+
+# Route for turning a stage's predicted_items (e.g. from /tasks or /task-list)
+# into Jira issues, or sub-tasks when a parent key is given. Takes
+# {projectKey, predicted_items, parent?, issueType?}. Sending the same export
+# again (or with the same Idempotency-Key header) returns the issues it
+# already created instead of making duplicates.
+@app.route('/jira-export', methods=['POST'])
+def jira_export():
+    body = request.get_json(silent=True) or {}
+    try:
+        result = jira_exporter.export(body.get('projectKey'), body.get('predicted_items'), body.get('parent'),
+                                      body.get('issueType'), request.headers.get('Idempotency-Key'))
+    except JiraExportError as e:
+        return jsonify({'error': str(e)}), 400
+
+    created = any(issue['status'] == 'created' for issue in result['issues'])
+    return jsonify(result), 201 if created else 200
+
+# Route for checking the Jira export counters
+@app.route('/jira-stats', methods=['GET'])
+def jira_stats():
+    return jsonify(jira_exporter.stats())
+
+# SALARY MODEL
+
+# Route for predicting salaries with the linear regression model. Takes one
+# {age, weight} record or a batch of them and scores the batch in one call.
+@app.route('/predict', methods=['POST'])
+def predict():
+    try:
+        features, single = parse_records(request.get_json())
+    except InvalidRecordsError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        predicted_salaries = predict_salaries(features)
+    except BatchQueueFullError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+
+    # Return the predicted salary (or salaries) as JSON response
+    if single:
+        return jsonify({'predicted_salary': int(predicted_salaries[0])})
+    return jsonify({'predicted_salaries': predicted_salaries.tolist()})
+
+GZIP_MIMETYPES = ('application/gzip', 'application/x-gzip')
+
+# Route for scoring a whole CSV (same columns as data/Data.csv, optionally
+# gzip'd), sent as the raw request body, e.g.
+#   curl --data-binary @rows.csv.gz -H 'Content-Encoding: gzip' .../predict-csv
+# The body is read and the result CSV streamed back chunk by chunk, so files
+# of any size use one chunk of memory.
+@app.route('/predict-csv', methods=['POST'])
+def predict_csv():
+    gzipped = request.headers.get('Content-Encoding', '').lower() == 'gzip' or request.mimetype in GZIP_MIMETYPES
+    try:
+        header, columns, lines = open_csv(request.stream, gzipped)
+    except InvalidRecordsError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return Response(stream_with_context(score_csv(header, columns, lines)), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=predictions.csv'})
+
+# Route for checking how full the prediction micro-batches are
+@app.route('/predict-stats', methods=['GET'])
+def predict_stats():
+    return jsonify(batcher.stats())
+
+# Route for checking which model version is being served
+@app.route('/model', methods=['GET'])
+def model():
+    return jsonify(model_info())
 
 # Run the Flask app
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from metrics import metrics, current_request
+from response_cache import normalize_input
+from prompt_pipeline import run_route, run_route_async
+
+try:
+    import pymongo
+except ImportError:
+    # Only needed for the MongoDB backend (installed with Flask-PyMongo)
+    pymongo = None
+
+# Load the .env file
+load_dotenv()
+
+# Artefact store settings (can be overridden in the .env file)
+# 'sqlite' (a local file, the default) or 'mongo'
+ARTEFACT_STORE = os.getenv("ARTEFACT_STORE", "sqlite").strip().lower()
+ARTEFACT_DB_PATH = os.getenv("ARTEFACT_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artefacts.sqlite3'))
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/pmai")
+ARTEFACT_COLLECTION = os.getenv("ARTEFACT_COLLECTION", "artefacts")
+
+FUNNEL_ID_MAX_CHARS = 128
+# Token counts taken from the per-request metrics record
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens')
+# Cache statuses whose payloads are served but not saved as this input's output
+UNSAVED_STATUSES = ('FALLBACK', 'NEAR_HIT')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artefacts (
+    funnel_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    output TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (funnel_id, stage)
+);
+CREATE INDEX IF NOT EXISTS artefacts_input ON artefacts (input_hash);
+"""
+
+
+# Raised for a funnel ID the store won't take (the route answers 400)
+class ArtefactError(ValueError):
+    pass
+
+
+# Identifies a stage's input. The prompt is part of it, so changing a
+# prompt means its stage is generated again.
+def input_hash(route, input_text):
+    payload = json.dumps([route.path, route.prompt_string, normalize_input(input_text)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def check_funnel_id(funnel_id):
+    if not isinstance(funnel_id, str) or not funnel_id or len(funnel_id) > FUNNEL_ID_MAX_CHARS:
+        raise ArtefactError("'funnelId' must be a string of at most %d characters" % FUNNEL_ID_MAX_CHARS)
+
+
+def _artefact(funnel_id, stage, input_hash, output, usage, updated):
+    return {'funnel_id': funnel_id, 'stage': stage, 'input_hash': input_hash, 'output': output,
+            'prompt_tokens': usage.get('prompt_tokens', 0), 'completion_tokens': usage.get('completion_tokens', 0),
+            'updated': updated}
+
+
+# Embedded backend: one SQLite file, one connection per thread and process
+class SqliteBackend:
+    def __init__(self, path=ARTEFACT_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def save(self, artefact):
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO artefacts (funnel_id, stage, input_hash, output, prompt_tokens, completion_tokens, updated) "
+                "VALUES (:funnel_id, :stage, :input_hash, :output, :prompt_tokens, :completion_tokens, :updated)",
+                dict(artefact, output=json.dumps(artefact['output'])))
+
+    def funnel(self, funnel_id):
+        rows = self._db().execute("SELECT * FROM artefacts WHERE funnel_id = ?", (funnel_id,)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def find(self, input_hash):
+        row = self._db().execute(
+            "SELECT * FROM artefacts WHERE input_hash = ? ORDER BY updated DESC LIMIT 1", (input_hash,)).fetchone()
+        return self._row(row) if row is not None else None
+
+    def _row(self, row):
+        return dict(row, output=json.loads(row['output']))
+
+
+# MongoDB backend, so every worker and host shares the same funnels
+class MongoBackend:
+    def __init__(self, uri=MONGO_URI, collection=ARTEFACT_COLLECTION):
+        if pymongo is None:
+            raise RuntimeError("ARTEFACT_STORE=mongo needs pymongo (pip install Flask-PyMongo)")
+        self.uri = uri
+        self.collection_name = collection
+        self._collection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # Connect on first use, so each gunicorn worker gets its own client after fork
+    def _collection_for_pid(self):
+        if self._collection is None or self._pid != os.getpid():
+            with self._lock:
+                if self._collection is None or self._pid != os.getpid():
+                    collection = pymongo.MongoClient(self.uri).get_default_database()[self.collection_name]
+                    collection.create_index([('funnel_id', pymongo.ASCENDING), ('stage', pymongo.ASCENDING)], unique=True)
+                    collection.create_index([('input_hash', pymongo.ASCENDING), ('updated', pymongo.DESCENDING)])
+                    self._collection = collection
+                    self._pid = os.getpid()
+        return self._collection
+
+    def save(self, artefact):
+        self._collection_for_pid().replace_one(
+            {'funnel_id': artefact['funnel_id'], 'stage': artefact['stage']}, artefact, upsert=True)
+
+    def funnel(self, funnel_id):
+        return list(self._collection_for_pid().find({'funnel_id': funnel_id}, {'_id': False}))
+
+    def find(self, input_hash):
+        return self._collection_for_pid().find_one({'input_hash': input_hash}, {'_id': False},
+                                                   sort=[('updated', pymongo.DESCENDING)])
+
+
+# Keeps each funnel stage's output, with the hash of its input and the tokens
+# it took, under the funnel's ID. Reloading or sharing a funnel is one indexed
+# read, and a stage whose input was already generated (in any funnel) is
+# answered from the store instead of going upstream again.
+class ArtefactStore:
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.counters = {'saved': 0, 'reused': 0, 'generated': 0, 'funnel_reads': 0}
+
+    def funnel(self, funnel_id):
+        self._count('funnel_reads')
+        return {artefact['stage']: artefact for artefact in self.backend.funnel(funnel_id)}
+
+    # Run a prompt route as one stage of a funnel and keep its output.
+    # Returns the payload and cache status, like run_route.
+    def run_stage(self, funnel_id, route, input_text, bypass_cache=False):
+        stored, artefact_hash = self._lookup(funnel_id, route, input_text, bypass_cache)
+        if stored is not None:
+            metrics.count_cache(route.path, 'STORED')
+            return stored['output'], 'STORED'
+        before = self._usage()
+        payload, cache_status = run_route(route, input_text, bypass_cache)
+        self._keep(funnel_id, route, artefact_hash, payload, cache_status, self._used_since(before))
+        return payload, cache_status
+
+    # Same as run_stage() for the asyncio serving mode; the store is called
+    # from the default thread pool so it never blocks the event loop
+    async def run_stage_async(self, funnel_id, route, input_text, bypass_cache=False):
+        loop = asyncio.get_running_loop()
+        stored, artefact_hash = await loop.run_in_executor(None, self._lookup, funnel_id, route, input_text, bypass_cache)
+        if stored is not None:
+            metrics.count_cache(route.path, 'STORED')
+            return stored['output'], 'STORED'
+        before = self._usage()
+        payload, cache_status = await run_route_async(route, input_text, bypass_cache)
+        # Read before leaving the event loop: executor threads don't see the request's context
+        usage = self._used_since(before)
+        await loop.run_in_executor(None, self._keep, funnel_id, route, artefact_hash, payload, cache_status, usage)
+        return payload, cache_status
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    # Stored output for this input, copied into this funnel if it came from another
+    def _lookup(self, funnel_id, route, input_text, bypass_cache):
+        check_funnel_id(funnel_id)
+        artefact_hash = input_hash(route, input_text)
+        if bypass_cache:
+            return None, artefact_hash
+        stored = self.backend.find(artefact_hash)
+        if stored is None:
+            return None, artefact_hash
+        self._count('reused')
+        if stored['funnel_id'] != funnel_id:
+            self.backend.save(dict(stored, funnel_id=funnel_id, updated=time.time()))
+        return stored, artefact_hash
+
+    def _keep(self, funnel_id, route, artefact_hash, payload, cache_status, usage):
+        self._count('generated')
+        # Error payloads (no completion) aren't worth keeping. A fallback
+        # model's answer would outlive the failover under the primary's hash,
+        # and a near-duplicate's was generated for a different input.
+        if 'predicted_items' not in payload or cache_status in UNSAVED_STATUSES:
+            return
+        self.backend.save(_artefact(funnel_id, route.path, artefact_hash, payload, usage, time.time()))
+        self._count('saved')
+
+    # Tokens this request has used so far: the metrics record adds up the
+    # usage of each upstream call made for it (none for cache hits)
+    def _usage(self):
+        record = current_request.get() or {}
+        return {name: int(record.get(name, 0)) for name in USAGE_FIELDS}
+
+    def _used_since(self, before):
+        after = self._usage()
+        return {name: after[name] - before[name] for name in USAGE_FIELDS}
+
+
+def open_backend(kind=ARTEFACT_STORE):
+    if kind == 'mongo':
+        return MongoBackend()
+    if kind != 'sqlite':
+        print("Unknown ARTEFACT_STORE %r, using sqlite" % kind, flush=True)
+    return SqliteBackend()
+
+
+# Shared store for this worker
+artefact_store = ArtefactStore(open_backend())
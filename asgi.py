@@ -0,0 +1,200 @@
+import json
+import math
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers
+from app import app
+from prompt_pipeline import ROUTES_BY_PATH, STREAM_ROUTES_BY_PATH, run_route_async, stream_route_async
+from response_cache import is_bypass
+from funnel_pipeline import parse_stages, run_pipeline_async, pipeline_events_async
+from upstream_client import upstream, UpstreamError
+from metrics import metrics
+from artefact_store import ArtefactError, artefact_store
+
+# Asyncio serving mode. The prompt routes are served natively on the event loop
+# with the async OpenAI client, so one process can hold hundreds of upstream calls
+# open at once. Every other request (and CORS preflight) falls through to the Flask app.
+#
+# Run with: gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+#       or: uvicorn asgi:application
+
+# The Flask app wrapped for ASGI, used for everything that is not a prompt route
+flask_app = WsgiToAsgi(app)
+
+
+# Read the whole request body from the ASGI receive channel
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+# Send a JSON response in the same format as Flask's jsonify
+async def send_json(send, status, payload, extra_headers=None):
+    body = (json.dumps(payload) + "\n").encode('utf-8')
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('latin-1')),
+        (b'access-control-allow-origin', b'*'),
+    ]
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+# Send Server-Sent Events from an async generator
+async def send_events(send, events, extra_headers=None):
+    headers = [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+        (b'access-control-allow-origin', b'*'),
+    ]
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    async for event in events:
+        await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+# Answer with 429/502/503 when the OpenAI API call fails or is shed (same as the Flask app)
+async def send_upstream_error(send, e):
+    headers = {}
+    if e.retry_after:
+        headers['Retry-After'] = str(int(math.ceil(e.retry_after)))
+    await send_json(send, e.status, {'error': str(e)}, headers)
+
+# Read the inputText field from a JSON request body, or None if it is missing
+async def read_input_text(receive):
+    input_text, _ = await read_prompt_body(receive)
+    return input_text
+
+# Read the inputText and optional funnelId fields from a JSON request body
+async def read_prompt_body(receive):
+    try:
+        body = json.loads(await read_body(receive))
+        return body['inputText'], body.get('funnelId')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None, None
+
+# Case-insensitive view of the ASGI request headers
+def request_headers(scope):
+    return Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+
+# Handle POST requests to a prompt route on the event loop
+async def prompt_endpoint(scope, receive, send):
+    route = ROUTES_BY_PATH[scope['path']]
+    metrics_token = metrics.start_request(route.path)
+    status = 500
+    try:
+        # Retrieve the input data from the request
+        with metrics.timed('parse_seconds', route.path):
+            input_text, funnel_id = await read_prompt_body(receive)
+        if input_text is None:
+            status = 400
+            await send_json(send, status, {'error': "Request body must be JSON with an 'inputText' field"})
+            return
+
+        bypass_cache = is_bypass(request_headers(scope))
+        try:
+            if funnel_id is not None:
+                payload, cache_status = await artefact_store.run_stage_async(funnel_id, route, input_text, bypass_cache)
+            else:
+                payload, cache_status = await run_route_async(route, input_text, bypass_cache)
+        except ArtefactError as e:
+            status = 400
+            await send_json(send, status, {'error': str(e)})
+            return
+        except UpstreamError as e:
+            status = e.status
+            await send_upstream_error(send, e)
+            return
+
+        status = 200
+        with metrics.timed('serialize_seconds', route.path):
+            await send_json(send, status, payload, {'X-Cache': cache_status})
+    finally:
+        metrics.finish_request(metrics_token, status)
+
+# Relay a long-form route's tokens to the client as Server-Sent Events.
+# Streams are timed until the last event is sent.
+async def stream_endpoint(scope, receive, send):
+    route = STREAM_ROUTES_BY_PATH[scope['path']]
+    metrics_token = metrics.start_request(route.stream_path)
+    status = 500
+    try:
+        with metrics.timed('parse_seconds', route.stream_path):
+            input_text = await read_input_text(receive)
+        if input_text is None:
+            status = 400
+            await send_json(send, status, {'error': "Request body must be JSON with an 'inputText' field"})
+            return
+
+        try:
+            events, cache_status = await stream_route_async(route, input_text, is_bypass(request_headers(scope)))
+        except UpstreamError as e:
+            status = e.status
+            await send_upstream_error(send, e)
+            return
+        status = 200
+        await send_events(send, events, {'X-Cache': cache_status})
+    finally:
+        metrics.finish_request(metrics_token, status)
+
+# Run a stage graph with every ready stage in flight at once
+async def pipeline_endpoint(scope, receive, send):
+    metrics_token = metrics.start_request('/pipeline')
+    status = 500
+    try:
+        try:
+            with metrics.timed('parse_seconds', '/pipeline'):
+                body = json.loads(await read_body(receive))
+                stages = parse_stages(body)
+        except ValueError as e:
+            # PipelineError is a ValueError, as are JSON decoding errors
+            status = 400
+            await send_json(send, status, {'error': str(e)})
+            return
+
+        bypass_cache = is_bypass(request_headers(scope))
+        if body.get('stream'):
+            status = 200
+            await send_events(send, pipeline_events_async(stages, bypass_cache))
+            return
+
+        results = {}
+        async for stage_id, payload in run_pipeline_async(stages, bypass_cache):
+            results[stage_id] = payload
+        status = 200
+        with metrics.timed('serialize_seconds', '/pipeline'):
+            await send_json(send, status, {'results': results})
+    finally:
+        metrics.finish_request(metrics_token, status)
+
+# Answer the server's startup/shutdown events
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Close the keep-alive connections to the OpenAI API
+            await upstream.close_aiosessions()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# ASGI entry point
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in ROUTES_BY_PATH:
+        await prompt_endpoint(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in STREAM_ROUTES_BY_PATH:
+        await stream_endpoint(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/pipeline':
+        await pipeline_endpoint(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
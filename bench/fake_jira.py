@@ -0,0 +1,194 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the parts of the Jira REST API the export uses: bulk
+# create, label search and the field list. Issues are kept in memory. It can
+# add latency and fail calls, including failing a bulk create *after* the
+# issues were made, which is the case idempotent retries have to handle.
+#
+# Run with: python -m bench.fake_jira --port 8200 --latency-ms 150 --fail-after-create-rate 0.3
+# and point the app at it with JIRA_SERVER=http://127.0.0.1:8200
+
+LABEL_JQL = re.compile(r'^labels\s*=\s*"?([^"\s]+)"?$')
+
+FIELDS = [
+    {'id': 'summary', 'name': 'Summary', 'clauseNames': ['summary']},
+    {'id': 'labels', 'name': 'Labels', 'clauseNames': ['labels']},
+    {'id': 'description', 'name': 'Description', 'clauseNames': ['description']},
+]
+
+
+class FakeJiraSettings:
+    def __init__(self, latency_ms=100.0, error_rate=0.0, fail_after_create_rate=0.0, seed=1234):
+        self.latency_ms = latency_ms
+        # Fraction of calls answered with a 503 before doing anything
+        self.error_rate = error_rate
+        # Fraction of bulk creates that create the issues and then answer 503 anyway
+        self.fail_after_create_rate = fail_after_create_rate
+        self.seed = seed
+
+
+class FakeJira:
+    def __init__(self, settings):
+        self.settings = settings
+        self.rng = random.Random(settings.seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.issues = {}
+            self.next_id = 10000
+            self.calls = {}
+            self.peak_in_flight = 0
+            self.in_flight = 0
+
+    def begin(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return self.rng.random(), self.rng.random()
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def create(self, fields):
+        with self._lock:
+            self.next_id += 1
+            project = fields['project'].get('key', 'PM')
+            key = '%s-%d' % (project, self.next_id)
+            self.issues[key] = {'id': str(self.next_id), 'key': key, 'self': '/rest/api/2/issue/%d' % self.next_id,
+                                'fields': fields}
+            return self.issues[key]
+
+    def search(self, label):
+        with self._lock:
+            return [issue for issue in self.issues.values() if label in issue['fields'].get('labels', [])]
+
+    def snapshot(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'issues': len(self.issues), 'peak_in_flight': self.peak_in_flight}
+
+
+def make_handler(jira):
+    class FakeJiraHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/stats':
+                self._send_json(200, jira.snapshot())
+            elif url.path == '/rest/api/2/field':
+                self._call('field', lambda: (200, FIELDS))
+            elif url.path == '/rest/api/2/serverInfo':
+                self._call('serverInfo', lambda: (200, {'versionNumbers': [9, 4, 0], 'deploymentType': 'Server'}))
+            elif url.path == '/rest/api/2/search':
+                self._call('search', lambda: self._search(parse_qs(url.query)))
+            else:
+                self._send_json(404, {'errorMessages': ['Not found'], 'errors': {}})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            url = urlparse(self.path)
+            if url.path == '/stats/reset':
+                jira.reset()
+                self._send_json(200, jira.snapshot())
+            elif url.path == '/rest/api/2/issue/bulk':
+                self._call('bulk', lambda: self._bulk(json.loads(body or b'{}')), after_create=True)
+            else:
+                self._send_json(404, {'errorMessages': ['Not found'], 'errors': {}})
+
+        def _call(self, endpoint, handle, after_create=False):
+            error_roll, after_roll = jira.begin(endpoint)
+            try:
+                time.sleep(jira.settings.latency_ms / 1000.0)
+                if error_roll < jira.settings.error_rate:
+                    self._send_json(503, {'errorMessages': ['Service unavailable'], 'errors': {}}, {'Retry-After': '0'})
+                    return
+                status, payload = handle()
+                if after_create and after_roll < jira.settings.fail_after_create_rate:
+                    self._send_json(503, {'errorMessages': ['Gateway timeout'], 'errors': {}}, {'Retry-After': '0'})
+                    return
+                self._send_json(status, payload)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                jira.end()
+
+        def _bulk(self, body):
+            issues = []
+            errors = []
+            for n, update in enumerate(body.get('issueUpdates', [])):
+                fields = update.get('fields', {})
+                if not fields.get('summary'):
+                    errors.append({'status': 400, 'failedElementNumber': n,
+                                   'elementErrors': {'errorMessages': [], 'errors': {'summary': 'You must specify a summary of the issue.'}}})
+                    continue
+                issue = jira.create(fields)
+                issues.append({'id': issue['id'], 'key': issue['key'], 'self': issue['self']})
+            return (201 if not errors else 400 if not issues else 201), {'issues': issues, 'errors': errors}
+
+        def _search(self, query):
+            match = LABEL_JQL.match(query.get('jql', [''])[0].strip())
+            if match is None:
+                return 400, {'errorMessages': ['Only "labels = x" queries are supported'], 'errors': {}}
+            found = jira.search(match.group(1))
+            start = int(query.get('startAt', ['0'])[0])
+            # Pages are capped like Jira Cloud's
+            limit = min(int(query.get('maxResults', ['50'])[0]), 100)
+            issues = [{'id': issue['id'], 'key': issue['key'], 'self': issue['self'],
+                       'fields': {'labels': issue['fields'].get('labels', [])}} for issue in found[start:start + limit]]
+            return 200, {'startAt': start, 'maxResults': limit, 'total': len(found), 'issues': issues}
+
+        def _send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+    return FakeJiraHandler
+
+
+# Start the fake API in a background thread. Returns the server and the fake's state.
+def start_fake_jira(settings, host='127.0.0.1', port=0):
+    jira = FakeJira(settings)
+    server = ThreadingHTTPServer((host, port), make_handler(jira))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, jira
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local fake of the Jira REST API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8200)
+    parser.add_argument('--latency-ms', type=float, default=100.0, help="delay added to every call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls answered with a 503")
+    parser.add_argument('--fail-after-create-rate', type=float, default=0.0,
+                        help="fraction of bulk creates answered with a 503 after creating the issues")
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    settings = FakeJiraSettings(args.latency_ms, args.error_rate, args.fail_after_create_rate, args.seed)
+    server, _ = start_fake_jira(settings, args.host, args.port)
+    print("Fake Jira API listening on http://%s:%d" % (args.host, server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
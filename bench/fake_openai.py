@@ -0,0 +1,252 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI chat completions API, used for benchmarks so we
+# don't spend money on GPT-4. It answers POST /v1/chat/completions (streamed or
+# not) after a simulated delay: time to first token plus completion tokens at a
+# sampled token rate. Everything is seeded, so the same settings and traffic
+# give the same answers and latencies.
+#
+# Run with: python -m bench.fake_openai --port 8100 --ttfb-ms 800 --tokens-per-second 25
+# and point the app at it with OPENAI_API_BASE=http://127.0.0.1:8100/v1
+
+WORDS = (
+    "user story feature customer metric dashboard onboarding retention churn signup "
+    "report export search filter notification billing invoice profile settings team "
+    "project task deadline priority backlog sprint release feedback survey analytics"
+).split()
+
+
+class FakeSettings:
+    def __init__(self, ttfb_ms=800.0, ttfb_sigma=0.4, tokens_per_second=25.0, tokens_sigma=0.3,
+                 fill_min=0.6, error_rate=0.0, retry_after=1.0, seed=1234):
+        # Time to first token is lognormal around ttfb_ms
+        self.ttfb_ms = ttfb_ms
+        self.ttfb_sigma = ttfb_sigma
+        # Generation speed is lognormal around tokens_per_second
+        self.tokens_per_second = tokens_per_second
+        self.tokens_sigma = tokens_sigma
+        # Completions use between fill_min and all of max_tokens
+        self.fill_min = fill_min
+        # Fraction of calls answered with a 429 and a Retry-After header
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.seed = seed
+
+
+# Tracks how many upstream calls are in flight, to spot worker saturation
+class FakeStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.errors = 0
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.busy_seconds = 0.0
+            self.started = time.monotonic()
+
+    def begin(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return time.monotonic()
+
+    def end(self, started, error=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.busy_seconds += time.monotonic() - started
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                # Little's law: average number of upstream calls open at once
+                'mean_in_flight': round(self.busy_seconds / elapsed, 3),
+            }
+
+
+# Everything about a completion is derived from the prompt and the seed, so
+# reruns are reproducible regardless of request order
+def plan_completion(settings, body):
+    prompt = json.dumps(body.get('messages', []), sort_keys=True)
+    digest = hashlib.sha256(('%s:%s' % (settings.seed, prompt)).encode('utf-8')).hexdigest()
+    rng = random.Random(int(digest[:16], 16))
+
+    max_tokens = int(body.get('max_tokens') or 200)
+    completion_tokens = max(1, int(max_tokens * rng.uniform(settings.fill_min, 1.0)))
+    ttfb = rng.lognormvariate(0, settings.ttfb_sigma) * settings.ttfb_ms / 1000.0
+    rate = rng.lognormvariate(0, settings.tokens_sigma) * settings.tokens_per_second
+    failed = rng.random() < settings.error_rate
+
+    # About 4 characters per token, split into list-style lines like GPT-4 gives
+    words = [rng.choice(WORDS) for _ in range(max(1, completion_tokens * 3 // 4))]
+    lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+    content = '\n'.join('%d. %s' % (n + 1, line) for n, line in enumerate(lines))
+    return {
+        'content': content,
+        'prompt_tokens': len(prompt) // 4 + 1,
+        'completion_tokens': completion_tokens,
+        'ttfb': ttfb,
+        'rate': rate,
+        'failed': failed,
+    }
+
+
+def make_handler(settings, stats):
+    class FakeOpenAIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, stats.snapshot())
+            else:
+                self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/stats/reset':
+                stats.reset()
+                self._send_json(200, stats.snapshot())
+                return
+            if not self.path.endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+                return
+
+            request_body = json.loads(body or b'{}')
+            plan = plan_completion(settings, request_body)
+            started = stats.begin()
+            try:
+                time.sleep(plan['ttfb'])
+                if plan['failed']:
+                    self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                                    {'Retry-After': str(settings.retry_after)})
+                    stats.end(started, error=True)
+                    return
+                if request_body.get('stream'):
+                    self._stream(request_body, plan)
+                else:
+                    time.sleep(plan['completion_tokens'] / plan['rate'])
+                    self._send_json(200, self._completion(request_body, plan))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            stats.end(started)
+
+        def _completion(self, request_body, plan):
+            return {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request_body.get('model', 'gpt-4'),
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': plan['content']},
+                    'finish_reason': 'stop',
+                }],
+                'usage': {
+                    'prompt_tokens': plan['prompt_tokens'],
+                    'completion_tokens': plan['completion_tokens'],
+                    'total_tokens': plan['prompt_tokens'] + plan['completion_tokens'],
+                },
+            }
+
+        # Send the completion as Server-Sent Events, one word at a time
+        def _stream(self, request_body, plan):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            pieces = plan['content'].split(' ')
+            delay = plan['completion_tokens'] / plan['rate'] / len(pieces)
+            for n, piece in enumerate(pieces):
+                text = piece if n == 0 else ' ' + piece
+                chunk = {
+                    'id': 'chatcmpl-fake',
+                    'object': 'chat.completion.chunk',
+                    'model': request_body.get('model', 'gpt-4'),
+                    'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}],
+                }
+                self._write_chunk('data: %s\n\n' % json.dumps(chunk))
+                time.sleep(delay)
+            self._write_chunk('data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+        def _write_chunk(self, text):
+            data = text.encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def _send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+    return FakeOpenAIHandler
+
+
+# Start the fake API in a background thread. Returns the server and its stats.
+def start_fake_openai(settings, host='127.0.0.1', port=0):
+    stats = FakeStats()
+    server = ThreadingHTTPServer((host, port), make_handler(settings, stats))
+    server.daemon_threads = True
+    # Allow the hundreds of concurrent connections the async mode opens
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def add_settings_arguments(parser):
+    parser.add_argument('--ttfb-ms', type=float, default=800.0, help="median time to first token")
+    parser.add_argument('--ttfb-sigma', type=float, default=0.4, help="lognormal spread of time to first token")
+    parser.add_argument('--tokens-per-second', type=float, default=25.0, help="median generation speed")
+    parser.add_argument('--tokens-sigma', type=float, default=0.3, help="lognormal spread of generation speed")
+    parser.add_argument('--fill-min', type=float, default=0.6, help="smallest fraction of max_tokens a completion uses")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls answered with a 429")
+    parser.add_argument('--seed', type=int, default=1234)
+
+def settings_from_arguments(args):
+    return FakeSettings(
+        ttfb_ms=args.ttfb_ms, ttfb_sigma=args.ttfb_sigma,
+        tokens_per_second=args.tokens_per_second, tokens_sigma=args.tokens_sigma,
+        fill_min=args.fill_min, error_rate=args.error_rate, seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local fake of the OpenAI chat completions API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    server, _ = start_fake_openai(settings_from_arguments(args), args.host, args.port)
+    print("Fake OpenAI API listening on http://%s:%d/v1" % (args.host, server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,291 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import requests
+from bench.fake_openai import start_fake_openai, add_settings_arguments, settings_from_arguments
+from prompt_pipeline import PROMPT_ROUTES
+
+# Offline load test. Starts the fake OpenAI API, starts the backend in the chosen
+# serving mode pointed at it, replays a seeded mix of funnel traffic against every
+# prompt route and reports throughput, latency percentiles and worker saturation.
+#
+# Run from the repo root, e.g.:
+#   python -m bench.load_test --mode gunicorn --workers 4 --concurrency 32 --requests 500
+#   python -m bench.load_test --mode async --workers 1 --concurrency 200 --output bench/results/async.json
+#   python -m bench.load_test --mode gunicorn --compare bench/results/baseline.json
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Commands for each serving mode ({port} and {workers} are filled in)
+SERVER_COMMANDS = {
+    'dev': [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', '{port}', '--with-threads'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '-w', '{workers}', '-b', '127.0.0.1:{port}', '--timeout', '300', 'wsgi:app'],
+    'async': [sys.executable, '-m', 'gunicorn', '-w', '{workers}', '-k', 'uvicorn.workers.UvicornWorker',
+              '-b', '127.0.0.1:{port}', '--timeout', '300', 'asgi:application'],
+}
+
+# Relative traffic per route, following the shape of the PM funnel
+ROUTE_WEIGHTS = {
+    '/openai-predict': 20, '/openai-solution': 15, '/tasks': 10, '/targetCustomer': 8,
+    '/dataElements': 8, '/hypothesis': 8, '/marketing-material': 6, '/feature-name': 6,
+    '/whats-next': 4, '/feature-assess': 4, '/task-list': 4, '/social-post': 3,
+    '/blog-post': 3, '/email-post': 3, '/frontend-code': 2, '/backend-code': 2,
+}
+STREAM_WEIGHT = 1
+
+# Later stages get the accumulated output of the earlier ones, so their inputs are longer
+STAGE_INPUT_SENTENCES = {'/openai-predict': 1, '/openai-solution': 1}
+DEFAULT_INPUT_SENTENCES = 8
+
+SENTENCES = [
+    "As a team lead, I want to see overdue tasks, so that I can unblock my team",
+    "Users drop off during onboarding because the signup form is too long",
+    "The dashboard should load in under two seconds for 95 percent of customers",
+    "Small business owners struggle to reconcile invoices with bank payments",
+    "Export the monthly report as CSV with one row per customer",
+    "Notify the account owner when a payment fails twice in a row",
+    "Target customer: operations managers at companies with 50 to 500 staff",
+    "Metric: weekly active teams using the shared backlog view",
+    "Hypothesis: 20 percent of trial users invite a teammate within a week",
+    "Acceptance criteria: search results update as the user types",
+]
+
+
+# Build the full, seeded list of requests up front so every run replays the same traffic
+def build_traffic(total, seed, repeat_ratio, include_streams=True):
+    rng = random.Random(seed)
+    targets = []
+    for route in PROMPT_ROUTES:
+        targets.append((route.path, ROUTE_WEIGHTS.get(route.path, 1)))
+        if include_streams and route.stream:
+            targets.append((route.stream_path, STREAM_WEIGHT))
+    paths = [path for path, _ in targets]
+    weights = [weight for _, weight in targets]
+
+    previous = {}
+    traffic = []
+    for _ in range(total):
+        path = rng.choices(paths, weights)[0]
+        # PMs often resubmit the same input, which exercises the response cache
+        if previous.get(path) and rng.random() < repeat_ratio:
+            input_text = rng.choice(previous[path])
+        else:
+            base_path = path[:-len('/stream')] if path.endswith('/stream') else path
+            count = STAGE_INPUT_SENTENCES.get(base_path, DEFAULT_INPUT_SENTENCES)
+            input_text = ', '.join(rng.choice(SENTENCES) for _ in range(count)) + ' #%d' % rng.randrange(10 ** 6)
+            previous.setdefault(path, []).append(input_text)
+        traffic.append((path, input_text))
+    return traffic
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarise(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': _ms(percentile(latencies, 0.50)),
+        'p95_ms': _ms(percentile(latencies, 0.95)),
+        'p99_ms': _ms(percentile(latencies, 0.99)),
+        'max_ms': _ms(max(latencies) if latencies else None),
+    }
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+# Replay the traffic with a fixed number of concurrent clients (closed loop)
+def run_load(base_url, traffic, concurrency, timeout):
+    results = [None] * len(traffic)
+    next_index = iter(range(len(traffic)))
+    index_lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with index_lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            path, input_text = traffic[index]
+            started = time.perf_counter()
+            try:
+                response = session.post(base_url + path, json={'inputText': input_text}, timeout=timeout,
+                                        stream=path.endswith('/stream'))
+                # Read the whole body so streamed routes are timed to the last event
+                for _ in response.iter_content(chunk_size=None):
+                    pass
+                status = response.status_code
+                cache_status = response.headers.get('X-Cache')
+            except requests.RequestException as e:
+                status = 'error: %s' % type(e).__name__
+                cache_status = None
+            results[index] = (path, status, cache_status, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def build_report(results, wall_seconds, upstream_stats, args):
+    ok = [r for r in results if r[1] == 200]
+    by_route = {}
+    for path, _, _, latency in ok:
+        by_route.setdefault(path, []).append(latency)
+    cache_hits = sum(1 for r in ok if r[2] == 'HIT')
+    errors = {}
+    for r in results:
+        if r[1] != 200:
+            errors[str(r[1])] = errors.get(str(r[1]), 0) + 1
+
+    # Little's law on the client side: average requests open against the app
+    app_in_flight = sum(r[3] for r in results) / wall_seconds
+    report = {
+        'mode': args.mode,
+        'workers': args.workers,
+        'concurrency': args.concurrency,
+        'requests': len(results),
+        'seed': args.seed,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(len(ok) / wall_seconds, 3),
+        'overall': summarise([r[3] for r in ok]),
+        'routes': {path: summarise(latencies) for path, latencies in sorted(by_route.items())},
+        'errors': errors,
+        'cache_hit_ratio': round(cache_hits / len(ok), 3) if ok else None,
+        'upstream': upstream_stats,
+        'app_mean_in_flight': round(app_in_flight, 3),
+    }
+    # Requests open against the app but not upstream are queued behind busy workers
+    if app_in_flight > 0:
+        report['queued_fraction'] = round(max(0.0, 1 - upstream_stats['mean_in_flight'] / app_in_flight), 3)
+    if args.mode != 'async':
+        report['worker_saturation'] = round(min(1.0, upstream_stats['mean_in_flight'] / args.workers), 3)
+    return report
+
+
+def print_report(report):
+    print("mode=%s workers=%s concurrency=%s requests=%s" % (
+        report['mode'], report['workers'], report['concurrency'], report['requests']))
+    print("throughput: %.2f req/s over %.1fs" % (report['throughput_rps'], report['wall_seconds']))
+    overall = report['overall']
+    print("latency: p50=%sms p95=%sms p99=%sms max=%sms" % (
+        overall['p50_ms'], overall['p95_ms'], overall['p99_ms'], overall['max_ms']))
+    print("cache hit ratio: %s, errors: %s" % (report['cache_hit_ratio'], report['errors'] or 'none'))
+    print("upstream in flight: mean=%s peak=%s, app in flight: mean=%s" % (
+        report['upstream']['mean_in_flight'], report['upstream']['peak_in_flight'], report['app_mean_in_flight']))
+    if 'worker_saturation' in report:
+        print("worker saturation: %s, queued fraction: %s" % (report['worker_saturation'], report.get('queued_fraction')))
+    print("%-28s %6s %9s %9s %9s" % ('route', 'count', 'p50_ms', 'p95_ms', 'p99_ms'))
+    for path, stats in report['routes'].items():
+        print("%-28s %6d %9s %9s %9s" % (path, stats['count'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+
+
+# Compare with an earlier report. Returns the list of regressions beyond tolerance.
+def compare_reports(report, baseline, tolerance):
+    regressions = []
+    if report['throughput_rps'] < baseline['throughput_rps'] * (1 - tolerance):
+        regressions.append("throughput %.2f < baseline %.2f" % (report['throughput_rps'], baseline['throughput_rps']))
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        current, previous = report['overall'][key], baseline['overall'][key]
+        if current is not None and previous is not None and current > previous * (1 + tolerance):
+            regressions.append("%s %.1f > baseline %.1f" % (key, current, previous))
+    return regressions
+
+
+def start_server(mode, port, workers, fake_url):
+    command = [part.format(port=port, workers=workers) for part in SERVER_COMMANDS[mode]]
+    env = dict(os.environ, OPENAI_API_BASE=fake_url, SECRET_KEY=os.getenv('SECRET_KEY', 'bench-key'))
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait until the app answers
+    base_url = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("%s server exited with code %s" % (mode, process.returncode))
+        try:
+            requests.get(base_url + '/cache-stats', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("%s server did not start within 60s" % mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against a fake OpenAI API")
+    parser.add_argument('--mode', choices=sorted(SERVER_COMMANDS), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers (ignored for dev)")
+    parser.add_argument('--port', type=int, default=8200)
+    parser.add_argument('--url', help="benchmark an already running server instead of starting one")
+    parser.add_argument('--fake-url', default='http://127.0.0.1:8100',
+                        help="with --url, the separately started bench.fake_openai the server talks to")
+    parser.add_argument('--fake-port', type=int, default=0, help="port for the fake OpenAI API (0 picks one)")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--repeat-ratio', type=float, default=0.2, help="chance a request resubmits an earlier input")
+    parser.add_argument('--no-streams', action='store_true', help="leave the /stream routes out of the mix")
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', help="write the JSON report here")
+    parser.add_argument('--compare', help="fail if this run regressed against an earlier JSON report")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed regression as a fraction")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    if args.mode == 'dev':
+        args.workers = 1
+
+    traffic = build_traffic(args.requests, args.seed, args.repeat_ratio, not args.no_streams)
+
+    # Against an already running server, read the stats of the fake it talks to
+    if args.url:
+        fake_url = args.fake_url.rstrip('/')
+        requests.post(fake_url + '/stats/reset', timeout=5)
+        results, wall_seconds = run_load(args.url.rstrip('/'), traffic, args.concurrency, args.timeout)
+        upstream_stats = requests.get(fake_url + '/stats', timeout=5).json()
+        report = build_report(results, wall_seconds, upstream_stats, args)
+    else:
+        fake_server, fake_stats = start_fake_openai(settings_from_arguments(args), port=args.fake_port)
+        fake_url = 'http://127.0.0.1:%d/v1' % fake_server.server_port
+        process = None
+        try:
+            process, base_url = start_server(args.mode, args.port, args.workers, fake_url)
+            fake_stats.reset()
+            results, wall_seconds = run_load(base_url, traffic, args.concurrency, args.timeout)
+            report = build_report(results, wall_seconds, fake_stats.snapshot(), args)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+            fake_server.shutdown()
+
+    print_report(report)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_reports(report, json.load(f), args.tolerance)
+        if regressions:
+            print("REGRESSIONS:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("No regressions against %s" % args.compare)
+
+
+if __name__ == '__main__':
+    main()
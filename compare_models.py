@@ -0,0 +1,177 @@
+import argparse
+import importlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sklearn.model_selection import KFold
+from dataset import load_salary_data
+
+# Compares regression models on the salary data with k-fold cross-validation.
+# Every (candidate, hyperparameters, fold) fit runs as its own task in a
+# process pool, so the grid uses every core. The best candidate is refitted on
+# all the data and written out like train_linear_regression.py does.
+#
+# Run with: python compare_models.py --folds 5
+# or pass your own candidates with --candidates candidates.json, shaped like
+# {"ridge": {"estimator": "sklearn.linear_model.Ridge", "grid": {"alpha": [0.1, 1, 10]}}}
+
+FEATURE_COLUMNS = ['Age', 'Weight']
+TARGET_COLUMN = 'Salary'
+
+# Candidates from oldMLStuff.py plus regularised linear models. Logistic
+# regression is left out: it treats every salary as its own class.
+CANDIDATES = {
+    'linear': {'estimator': 'sklearn.linear_model.LinearRegression', 'grid': {}},
+    'ridge': {'estimator': 'sklearn.linear_model.Ridge', 'grid': {'alpha': [0.1, 1.0, 10.0, 100.0]}},
+    'lasso': {'estimator': 'sklearn.linear_model.Lasso', 'grid': {'alpha': [0.1, 1.0, 10.0, 100.0], 'max_iter': [10000]}},
+    'decision_tree': {
+        'estimator': 'sklearn.tree.DecisionTreeRegressor',
+        'grid': {'max_depth': [2, 3, 5, None], 'min_samples_leaf': [1, 3, 5], 'random_state': [0]},
+    },
+}
+
+# Data loaded once per pool worker by load_worker_data
+_X = None
+_y = None
+
+
+# Reads the columnar cache (see dataset.py), so each worker maps the parsed
+# columns instead of parsing the CSV again
+def load_worker_data(path):
+    global _X, _y
+    _X, _y = load_salary_data(path, FEATURE_COLUMNS, TARGET_COLUMN)
+
+
+def make_estimator(dotted_path, params):
+    module_name, _, class_name = dotted_path.rpartition('.')
+    return getattr(importlib.import_module(module_name), class_name)(**params)
+
+
+# Every combination of a grid, e.g. {'a': [1, 2]} -> [{'a': 1}, {'a': 2}]
+def expand_grid(grid):
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# Fit one candidate on one fold (runs in a pool worker). The folds are rebuilt
+# from the seed, so only the fold number crosses the process boundary.
+def run_fold(name, dotted_path, params, fold, folds, seed):
+    train_index, test_index = list(KFold(n_splits=folds, shuffle=True, random_state=seed).split(_X))[fold]
+    estimator = make_estimator(dotted_path, params)
+
+    start = time.perf_counter()
+    estimator.fit(_X[train_index], _y[train_index])
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predicted = estimator.predict(_X[test_index])
+    predict_seconds = time.perf_counter() - start
+
+    mse = float(np.mean((_y[test_index] - predicted) ** 2))
+    return name, json.dumps(params, sort_keys=True), mse, fit_seconds, predict_seconds
+
+
+def compare(path, candidates=CANDIDATES, folds=5, seed=42, workers=None):
+    tasks = [
+        (name, spec['estimator'], params, fold, folds, seed)
+        for name, spec in candidates.items()
+        for params in expand_grid(spec['grid'])
+        for fold in range(folds)
+    ]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=load_worker_data, initargs=(path,)) as pool:
+        futures = [pool.submit(run_fold, *task) for task in tasks]
+        fold_results = [future.result() for future in futures]
+
+    grouped = {}
+    for name, params, mse, fit_seconds, predict_seconds in fold_results:
+        grouped.setdefault((name, params), []).append((mse, fit_seconds, predict_seconds))
+
+    results = []
+    for (name, params), rows in grouped.items():
+        mses, fits, predicts = (np.array(column) for column in zip(*rows))
+        results.append({
+            'candidate': name,
+            'estimator': candidates[name]['estimator'],
+            'params': json.loads(params),
+            'mse': float(mses.mean()),
+            'mse_std': float(mses.std()),
+            'fit_ms': round(float(fits.mean()) * 1000, 3),
+            'predict_ms': round(float(predicts.mean()) * 1000, 3),
+        })
+    results.sort(key=lambda result: result['mse'])
+    return results, len(tasks)
+
+
+def print_results(results):
+    print('%-14s %-60s %16s %14s %9s %11s' % ('candidate', 'params', 'mse', 'mse_std', 'fit_ms', 'predict_ms'))
+    for result in results:
+        print('%-14s %-60s %16.1f %14.1f %9.3f %11.3f' % (
+            result['candidate'], json.dumps(result['params'], sort_keys=True)[:60],
+            result['mse'], result['mse_std'], result['fit_ms'], result['predict_ms']))
+
+
+# The served artefact only holds a linear model (coefficients + intercept)
+def is_linear(result):
+    return result['estimator'].startswith('sklearn.linear_model.')
+
+
+# Refit the winner on all the data and write it out the same way
+# train_linear_regression.py does: pickle, numpy artefact and a registry version
+def export_winner(path, result, folds):
+    import joblib
+    from salary_model import MODEL_ARTEFACT_PATH, from_sklearn, publish_model, save_artefact
+
+    X, y = load_salary_data(path, FEATURE_COLUMNS, TARGET_COLUMN)
+    estimator = make_estimator(result['estimator'], result['params'])
+    estimator.fit(X, y)
+
+    joblib.dump(estimator, 'trained_model.pkl')
+    model = from_sklearn(estimator)
+    save_artefact(model, MODEL_ARTEFACT_PATH)
+    return publish_model(
+        model, mse=result['mse'], rows=len(y), train_rows=len(y), cv_folds=folds,
+        estimator=result['estimator'], params=result['params'],
+        trained_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), trainer='compare_models.py',
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cross-validate regression models on the salary data")
+    parser.add_argument('--data', default='./data/Data.csv')
+    parser.add_argument('--candidates', help="JSON file of candidates (default: the built-in set)")
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42, help="seed for the fold shuffle")
+    parser.add_argument('--workers', type=int, default=None, help="pool size (default: every core)")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    parser.add_argument('--no-export', action='store_true', help="only report, don't write out the winner")
+    args = parser.parse_args()
+
+    candidates = CANDIDATES
+    if args.candidates:
+        with open(args.candidates) as f:
+            candidates = json.load(f)
+
+    start = time.perf_counter()
+    results, task_count = compare(args.data, candidates, args.folds, args.seed, args.workers)
+    print("%d fits across %d workers in %.2fs" % (task_count, args.workers or os.cpu_count(), time.perf_counter() - start))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    servable = [result for result in results if is_linear(result)]
+    if results[0] not in servable:
+        print("Best overall is %s %s, but only linear models can be served; using the best linear one"
+              % (results[0]['candidate'], json.dumps(results[0]['params'], sort_keys=True)))
+    if not servable:
+        raise SystemExit("No linear candidate to write out")
+    winner = servable[0]
+    print("Winner: %s %s (MSE %.1f)" % (winner['candidate'], json.dumps(winner['params'], sort_keys=True), winner['mse']))
+
+    if not args.no_export:
+        version = export_winner(args.data, winner, args.folds)
+        print("Exported the winner and published model version", version)
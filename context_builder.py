@@ -0,0 +1,124 @@
+import os
+from dotenv import load_dotenv
+from rate_limiter import estimate_prompt_tokens
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    # Without tiktoken, token counts fall back to the scheduler's estimate
+    _encoding = None
+
+# Load the .env file
+load_dotenv()
+
+# Context compaction settings (can be overridden in the .env file)
+# Accumulated input is packed into blocks of about this many tokens. Blocks
+# are packed from the start, so earlier blocks stay the same as later stages
+# append to the input and their summaries can be reused.
+CONTEXT_BLOCK_TOKENS = int(os.getenv("CONTEXT_BLOCK_TOKENS", "200"))
+# Repeated items at least this long are only kept once
+CONTEXT_DEDUPE_MIN_CHARS = int(os.getenv("CONTEXT_DEDUPE_MIN_CHARS", "40"))
+# Summarise blocks in the background so later stages can send the summary
+# instead, within their own token budget per minute. Off by default, since
+# every summary is an extra upstream call.
+CONTEXT_SUMMARIES_ENABLED = os.getenv("CONTEXT_SUMMARIES_ENABLED", "").strip().lower() in ('1', 'true', 'yes')
+CONTEXT_SUMMARY_TPM = int(os.getenv("CONTEXT_SUMMARY_TPM", "10000"))
+
+# Separator the frontend uses between items from earlier stages
+ITEM_SEPARATOR = ', '
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return estimate_prompt_tokens(text)
+
+
+# Cut text down to about budget tokens, at a word boundary
+def truncate_tokens(text, budget):
+    if budget <= 0:
+        return ''
+    if _encoding is not None:
+        tokens = _encoding.encode(text)
+        if len(tokens) <= budget:
+            return text
+        text = _encoding.decode(tokens[:budget])
+    elif count_tokens(text) <= budget:
+        return text
+    else:
+        text = text[:budget * 4]
+    return text.rsplit(' ', 1)[0] if ' ' in text else text
+
+
+# Split the accumulated input into items, dropping repeats of long items
+def split_items(input_text):
+    seen = set()
+    items = []
+    for item in input_text.split(ITEM_SEPARATOR):
+        normalized = ' '.join(item.split()).lower()
+        if len(normalized) >= CONTEXT_DEDUPE_MIN_CHARS:
+            if normalized in seen:
+                continue
+            seen.add(normalized)
+        items.append(item)
+    return items
+
+
+# Greedily pack items into blocks of about block_tokens tokens
+def pack_blocks(items, block_tokens=CONTEXT_BLOCK_TOKENS):
+    blocks = []
+    current = []
+    current_tokens = 0
+    for item in items:
+        tokens = count_tokens(item)
+        if current and current_tokens + tokens > block_tokens:
+            blocks.append(ITEM_SEPARATOR.join(current))
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        blocks.append(ITEM_SEPARATOR.join(current))
+    return blocks
+
+
+# Fit the accumulated input into budget tokens. Input that already fits is
+# returned unchanged. Otherwise, older blocks are swapped for their cached
+# summary when summary_fn(block) has one (blocks without one are returned
+# in to_summarise so the caller can summarise them for next time), and if
+# that's still too long the first block (the problem statement) and the
+# newest blocks are kept and the middle is cut.
+# Returns the compacted input and the blocks to summarise.
+def compact(input_text, budget, summary_fn):
+    if count_tokens(input_text) <= budget:
+        return input_text, []
+
+    blocks = pack_blocks(split_items(input_text))
+    to_summarise = []
+    # The newest block is what this stage is about, so it stays verbatim
+    for n, block in enumerate(blocks[:-1]):
+        summary = summary_fn(block)
+        if summary is None:
+            to_summarise.append(block)
+        elif count_tokens(summary) < count_tokens(block):
+            blocks[n] = summary
+
+    sizes = [count_tokens(block) for block in blocks]
+    if sum(sizes) > budget:
+        # First block, then newest to oldest while they fit; the block where
+        # the budget runs out is truncated and anything older is dropped
+        first = truncate_tokens(blocks[0], budget // 4) if len(blocks) > 1 else truncate_tokens(blocks[0], budget)
+        remaining = budget - count_tokens(first)
+        kept = []
+        for block, size in zip(reversed(blocks[1:]), reversed(sizes[1:])):
+            if size <= remaining:
+                kept.append(block)
+                remaining -= size
+            else:
+                partial = truncate_tokens(block, remaining)
+                if partial:
+                    kept.append(partial)
+                break
+        blocks = [first] + list(reversed(kept))
+
+    return ITEM_SEPARATOR.join(block for block in blocks if block), to_summarise
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on this platform, so concurrent first loads may both build the cache
+    fcntl = None
+
+# Load the .env file
+load_dotenv()
+
+# Columnar cache of numeric CSV datasets. The first load parses the CSV (in
+# chunks, so any size works) into one float64 .npy file per column; later
+# loads memory-map those files, so scripts and workers get zero-copy numpy
+# views instead of re-parsing text. The cache is rebuilt when the CSV changes: a
+# size/mtime mismatch triggers a content hash, and only a different hash
+# means a rebuild.
+#
+#   data/.cache/Data/
+#     manifest.json      source size, mtime, sha256, rows, columns
+#     <sha256[:16]>/     Age.npy, Weight.npy, Salary.npy
+DATA_CACHE_DIR = os.getenv("DATA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', '.cache'))
+DATA_CACHE_CHUNK_ROWS = int(os.getenv("DATA_CACHE_CHUNK_ROWS", "1000000"))
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_manifest(cache_dir, manifest):
+    tmp_path = os.path.join(cache_dir, '.%s.%d.tmp' % (MANIFEST_FILE, os.getpid()))
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(cache_dir, MANIFEST_FILE))
+
+
+# Manifest that is still valid for the CSV, or None if the cache needs building
+def _valid_manifest(cache_dir, source):
+    manifest = _read_manifest(cache_dir)
+    if manifest is None or not os.path.isdir(os.path.join(cache_dir, manifest['sha256'][:16])):
+        return None
+    stat = os.stat(source)
+    if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns:
+        return manifest
+    # Touched but maybe not changed (e.g. a fresh checkout): compare contents
+    if manifest['size'] == stat.st_size and manifest['sha256'] == file_sha256(source):
+        manifest = dict(manifest, mtime_ns=stat.st_mtime_ns)
+        _write_manifest(cache_dir, manifest)
+        return manifest
+    return None
+
+
+# Parse the CSV chunk by chunk into raw per-column files, then give each one
+# an .npy header once the row count is known
+def _build(cache_dir, source, chunk_rows):
+    stat = os.stat(source)
+    sha256 = file_sha256(source)
+    columns_dir = os.path.join(cache_dir, sha256[:16])
+    tmp_dir = os.path.join(cache_dir, '.build.%d.tmp' % os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    raw_files = {}
+    rows = 0
+    try:
+        try:
+            for chunk in pd.read_csv(source, chunksize=chunk_rows):
+                if not raw_files:
+                    raw_files = {name: open(os.path.join(tmp_dir, name + '.raw'), 'wb') for name in chunk.columns}
+                for name in chunk.columns:
+                    raw_files[name].write(chunk[name].to_numpy(dtype=np.float64).tobytes())
+                rows += len(chunk)
+        finally:
+            for f in raw_files.values():
+                f.close()
+
+        dtype = np.dtype(np.float64)
+        for name in raw_files:
+            raw_path = os.path.join(tmp_dir, name + '.raw')
+            with open(os.path.join(tmp_dir, name + '.npy'), 'wb') as out, open(raw_path, 'rb') as raw:
+                np.lib.format.write_array_header_1_0(out, {'descr': dtype.str, 'fortran_order': False, 'shape': (rows,)})
+                shutil.copyfileobj(raw, out, 1 << 20)
+            os.remove(raw_path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # Columns go into place before the manifest that points at them
+    shutil.rmtree(columns_dir, ignore_errors=True)
+    os.rename(tmp_dir, columns_dir)
+    old = _read_manifest(cache_dir)
+    manifest = {
+        'source': os.path.abspath(source),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256,
+        'rows': rows,
+        'columns': list(raw_files),
+    }
+    _write_manifest(cache_dir, manifest)
+    # Readers that already mapped the old columns keep them until they let go
+    if old is not None and old['sha256'][:16] != sha256[:16]:
+        shutil.rmtree(os.path.join(cache_dir, old['sha256'][:16]), ignore_errors=True)
+    return manifest
+
+
+# Columns of a CSV as read-only memory-mapped float64 arrays, keyed by the
+# header names. Builds (or rebuilds) the cache first if the CSV has changed.
+def load_columns(source, columns=None, cache_dir=None, chunk_rows=DATA_CACHE_CHUNK_ROWS):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    cache_dir = os.path.join(cache_dir or DATA_CACHE_DIR, stem)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    manifest = _valid_manifest(cache_dir, source)
+    if manifest is None:
+        lock_fd = os.open(os.path.join(cache_dir, '.lock'), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            # Another process may have built it while we waited
+            manifest = _valid_manifest(cache_dir, source) or _build(cache_dir, source, chunk_rows)
+        finally:
+            os.close(lock_fd)
+
+    columns_dir = os.path.join(cache_dir, manifest['sha256'][:16])
+    missing = [name for name in (columns or ()) if name not in manifest['columns']]
+    if missing:
+        raise KeyError("%s has no column %s" % (source, ', '.join(missing)))
+    return {name: np.load(os.path.join(columns_dir, name + '.npy'), mmap_mode='r') for name in (columns or manifest['columns'])}
+
+
+# Feature matrix and target for the salary data. X is a fresh (n, 2) array
+# built from the mapped columns; y is the mapped column itself.
+def load_salary_data(source='./data/Data.csv', features=('Age', 'Weight'), target='Salary'):
+    columns = load_columns(source, list(features) + [target])
+    return np.column_stack([columns[name] for name in features]), columns[target]
@@ -0,0 +1,197 @@
+import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+from prompt_pipeline import ROUTES_BY_PATH, run_route, run_route_async, sse_event
+
+# Load the .env file
+load_dotenv()
+
+# Most stages one /pipeline request runs at the same time in a sync worker
+PIPELINE_MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", "8"))
+
+# Placeholders like {stories} in a stage's inputText refer to earlier stage results
+PLACEHOLDER = re.compile(r'\{([A-Za-z0-9_-]+)\}')
+
+
+# Raised for a /pipeline body that can't be run (the route answers 400)
+class PipelineError(ValueError):
+    pass
+
+
+# One node in the stage graph
+class Stage:
+    def __init__(self, stage_id, route, input_template, after):
+        self.id = stage_id
+        self.route = route
+        self.input_template = input_template
+        self.after = after
+
+
+# Validate the request body and build the stage graph.
+# Each stage is {"id": ..., "route": "/tasks", "inputText": "... {other_id} ...", "after": [...]}.
+# A stage depends on every stage it names in a placeholder plus the ones listed in "after".
+def parse_stages(body):
+    if not isinstance(body, dict) or not isinstance(body.get('stages'), list) or not body['stages']:
+        raise PipelineError("Request body must be JSON with a non-empty 'stages' list")
+
+    raw_stages = body['stages']
+    ids = set()
+    for raw in raw_stages:
+        if not isinstance(raw, dict) or not isinstance(raw.get('id'), str) or not raw['id']:
+            raise PipelineError("Every stage needs a string 'id'")
+        if raw['id'] in ids:
+            raise PipelineError("Duplicate stage id: %s" % raw['id'])
+        ids.add(raw['id'])
+
+    stages = []
+    for raw in raw_stages:
+        route = ROUTES_BY_PATH.get(raw.get('route'))
+        if route is None:
+            raise PipelineError("Unknown route for stage %s: %s" % (raw['id'], raw.get('route')))
+        if not isinstance(raw.get('inputText'), str):
+            raise PipelineError("Stage %s needs a string 'inputText'" % raw['id'])
+
+        after = raw.get('after', [])
+        if not isinstance(after, list) or any(dep not in ids for dep in after):
+            raise PipelineError("Stage %s has an unknown stage in 'after'" % raw['id'])
+
+        # Only names of other stages count as placeholders, so literal braces are left alone
+        referenced = [name for name in PLACEHOLDER.findall(raw['inputText']) if name in ids]
+        deps = []
+        for dep in referenced + after:
+            if dep == raw['id']:
+                raise PipelineError("Stage %s depends on itself" % raw['id'])
+            if dep not in deps:
+                deps.append(dep)
+        stages.append(Stage(raw['id'], route, raw['inputText'], deps))
+
+    _check_acyclic(stages)
+    return stages
+
+def _check_acyclic(stages):
+    remaining = {stage.id: set(stage.after) for stage in stages}
+    while remaining:
+        ready = [stage_id for stage_id, deps in remaining.items() if not deps]
+        if not ready:
+            raise PipelineError("Stage graph has a cycle between: %s" % ', '.join(sorted(remaining)))
+        for stage_id in ready:
+            del remaining[stage_id]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+
+# Turn a stage result into text for a downstream prompt.
+# Lists are joined with ', ' which the routes split back into items.
+def result_text(payload):
+    items = payload['predicted_items']
+    if isinstance(items, list):
+        return ', '.join(item for item in items if item.strip())
+    return items
+
+# Fill the placeholders in a stage's inputText with the upstream results
+def fill_input(stage, results):
+    def replace(match):
+        name = match.group(1)
+        if name in stage.after:
+            return result_text(results[name])
+        return match.group(0)
+    return PLACEHOLDER.sub(replace, stage.input_template)
+
+def _failed_dependency(stage, results):
+    for dep in stage.after:
+        if 'error' in results[dep]:
+            return dep
+    return None
+
+
+# Run the stage graph on a thread pool, starting every stage as soon as its
+# dependencies have finished. Yields (stage_id, payload) in completion order.
+def run_pipeline(stages, bypass_cache=False):
+    results = {}
+    pending = list(stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS) as executor:
+        while pending or running:
+            # Start (or skip) every stage whose dependencies are done
+            for stage in list(pending):
+                if not all(dep in results for dep in stage.after):
+                    continue
+                pending.remove(stage)
+                failed = _failed_dependency(stage, results)
+                if failed:
+                    results[stage.id] = {'error': "Upstream stage %s failed" % failed}
+                    yield stage.id, results[stage.id]
+                    continue
+                future = executor.submit(run_route, stage.route, fill_input(stage, results), bypass_cache, False)
+                running[future] = stage
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.id], _ = future.result()
+                except Exception as e:
+                    print("Pipeline stage %s failed: %s" % (stage.id, e))
+                    results[stage.id] = {'error': str(e)}
+                yield stage.id, results[stage.id]
+
+# Same as run_pipeline() but on the event loop with the async client
+async def run_pipeline_async(stages, bypass_cache=False):
+    results = {}
+    pending = list(stages)
+    running = {}
+
+    while pending or running:
+        for stage in list(pending):
+            if not all(dep in results for dep in stage.after):
+                continue
+            pending.remove(stage)
+            failed = _failed_dependency(stage, results)
+            if failed:
+                results[stage.id] = {'error': "Upstream stage %s failed" % failed}
+                yield stage.id, results[stage.id]
+                continue
+            task = asyncio.ensure_future(run_route_async(stage.route, fill_input(stage, results), bypass_cache, False))
+            running[task] = stage
+
+        if not running:
+            continue
+
+        try:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # The client went away, so stop the upstream calls still in flight
+            for task in running:
+                task.cancel()
+            raise
+        for task in done:
+            stage = running.pop(task)
+            try:
+                results[stage.id], _ = task.result()
+            except Exception as e:
+                print("Pipeline stage %s failed: %s" % (stage.id, e))
+                results[stage.id] = {'error': str(e)}
+            yield stage.id, results[stage.id]
+
+
+# Server-Sent Events for a streamed /pipeline request: one 'stage' event per
+# finished stage and a final 'done' event with every result
+def pipeline_events(stages, bypass_cache=False):
+    results = {}
+    for stage_id, payload in run_pipeline(stages, bypass_cache):
+        results[stage_id] = payload
+        yield sse_event('stage', {'id': stage_id, 'result': payload})
+    yield sse_event('done', {'results': results})
+
+async def pipeline_events_async(stages, bypass_cache=False):
+    results = {}
+    async for stage_id, payload in run_pipeline_async(stages, bypass_cache):
+        results[stage_id] = payload
+        yield sse_event('stage', {'id': stage_id, 'result': payload})
+    yield sse_event('done', {'results': results})
@@ -0,0 +1,296 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from dotenv import load_dotenv
+from jira import JIRA, JIRAError
+from upstream_client import UpstreamError, backoff_delay, retry_after_seconds
+
+# Load the .env file
+load_dotenv()
+
+# Jira export settings (can be overridden in the .env file)
+JIRA_SERVER = os.getenv("JIRA_SERVER", "")
+JIRA_EMAIL = os.getenv("JIRA_EMAIL", "")
+JIRA_API_TOKEN = os.getenv("JIRA_API_TOKEN", "")
+JIRA_ISSUE_TYPE = os.getenv("JIRA_ISSUE_TYPE", "Task")
+JIRA_SUBTASK_TYPE = os.getenv("JIRA_SUBTASK_TYPE", "Sub-task")
+# Issues per bulk-create call (Jira accepts at most 50)
+JIRA_BATCH_SIZE = min(int(os.getenv("JIRA_BATCH_SIZE", "50")), 50)
+# Bulk-create calls one export makes at once, and keep-alive connections per worker
+JIRA_MAX_PARALLEL = int(os.getenv("JIRA_MAX_PARALLEL", "4"))
+JIRA_POOL_SIZE = int(os.getenv("JIRA_POOL_SIZE", "8"))
+JIRA_TIMEOUT = float(os.getenv("JIRA_TIMEOUT", "30"))
+JIRA_MAX_RETRIES = int(os.getenv("JIRA_MAX_RETRIES", "3"))
+# Issue keys each export created, kept locally since Jira's search index can
+# lag behind a create. Kept this long, so a retry within it finds them.
+JIRA_EXPORT_DB_PATH = os.getenv("JIRA_EXPORT_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jira_exports.sqlite3'))
+JIRA_EXPORT_TTL_SECONDS = float(os.getenv("JIRA_EXPORT_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Jira cuts summaries off at 255 characters
+SUMMARY_MAX_CHARS = 255
+LABEL_PREFIX = 'pmai-'
+# Issues per search call (Jira Cloud returns at most 100)
+SEARCH_PAGE_SIZE = 100
+# How often records of old exports are deleted
+PURGE_INTERVAL = 3600.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exported_issues (
+    export_id TEXT NOT NULL,
+    item INTEGER NOT NULL,
+    issue_key TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (export_id, item)
+);
+CREATE INDEX IF NOT EXISTS exported_issues_created ON exported_issues (created);
+"""
+
+
+# Raised for an export request that can't be sent (the route answers 400)
+class JiraExportError(ValueError):
+    pass
+
+
+def is_retryable(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(error, JIRAError) and (error.status_code == 429 or (error.status_code or 500) >= 500)
+
+
+# The export's ID: the client's Idempotency-Key, or a hash of what would be
+# created, so sending the same export twice finds the issues from the first
+def export_id(project, parent, issue_type, items, idempotency_key=None):
+    source = idempotency_key or json.dumps([project, parent, issue_type, items])
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+
+# Fields for one issue. Every issue carries the export's label and its own,
+# which is how a retry finds what was already created.
+def issue_fields(project, parent, issue_type, item, export, n):
+    lines = item.strip().splitlines() or ['']
+    summary = lines[0].strip()
+    if len(summary) > SUMMARY_MAX_CHARS:
+        summary = summary[:SUMMARY_MAX_CHARS - 3].rsplit(' ', 1)[0] + '...'
+    fields = {
+        # Project and issue type by key/name, so the client doesn't look them up first
+        'project': {'key': project},
+        'issuetype': {'name': issue_type},
+        'summary': summary,
+        'labels': [LABEL_PREFIX + export, '%s%s-%d' % (LABEL_PREFIX, export, n)],
+    }
+    if summary != item.strip():
+        fields['description'] = item.strip()
+    if parent:
+        fields['parent'] = {'key': parent}
+    return fields
+
+
+# Issue keys created per export, in a SQLite file shared by every worker
+# process on the machine, one connection per thread and process
+class ExportRecords:
+    def __init__(self, path=JIRA_EXPORT_DB_PATH, ttl=JIRA_EXPORT_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    # Item index -> issue key for what this export created within the TTL
+    def find(self, export):
+        rows = self._db().execute("SELECT item, issue_key FROM exported_issues WHERE export_id = ? AND created >= ?",
+                                  (export, time.time() - self.ttl)).fetchall()
+        return dict(rows)
+
+    def save(self, export, keys):
+        now = time.time()
+        db = self._db()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO exported_issues (export_id, item, issue_key, created) VALUES (?, ?, ?, ?)",
+                           [(export, n, key, now) for n, key in keys.items()])
+            if now - self._last_purge >= PURGE_INTERVAL:
+                self._last_purge = now
+                db.execute("DELETE FROM exported_issues WHERE created < ?", (now - self.ttl,))
+
+
+# Creates Jira issues (or sub-tasks) from a stage's predicted_items with the
+# bulk-create API, a batch of up to 50 per call and a few batches at once.
+# Retries never create duplicates: before a batch is resent, the issues this
+# export is known to have created (recorded locally, and found in Jira by
+# their labels) are left out and only the missing ones are sent.
+class JiraExporter:
+    def __init__(self, server=JIRA_SERVER, email=JIRA_EMAIL, api_token=JIRA_API_TOKEN, batch_size=JIRA_BATCH_SIZE,
+                 max_parallel=JIRA_MAX_PARALLEL, pool_size=JIRA_POOL_SIZE, max_retries=JIRA_MAX_RETRIES, records=None):
+        self.records = records if records is not None else ExportRecords()
+        self.server = server
+        self.email = email
+        self.api_token = api_token
+        self.batch_size = batch_size
+        self.max_parallel = max_parallel
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.counters = {'exports': 0, 'created': 0, 'existing': 0, 'failed': 0, 'api_calls': 0, 'retries': 0}
+
+    # One authenticated client per worker, its session pooled for the parallel batches
+    def client(self):
+        if not self.server:
+            raise UpstreamError("Jira export is not configured (set JIRA_SERVER)", status=503)
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    # Retries are done here, where they can be made idempotent
+                    client = JIRA(self.server, basic_auth=(self.email, self.api_token), get_server_info=False,
+                                  max_retries=0, timeout=JIRA_TIMEOUT)
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    client._session.mount('https://', adapter)
+                    client._session.mount('http://', adapter)
+                    self._client = client
+                    self._pid = os.getpid()
+        return self._client
+
+    # Create one issue per item. Returns the export ID and, per item, its
+    # issue key and whether it was created now or already existed.
+    def export(self, project, items, parent=None, issue_type=None, idempotency_key=None):
+        if not isinstance(project, str) or not project:
+            raise JiraExportError("Export needs a 'projectKey'")
+        if not isinstance(items, list) or not items or not all(isinstance(item, str) and item.strip() for item in items):
+            raise JiraExportError("Export needs 'predicted_items', a list of non-empty strings")
+        if parent is not None and not isinstance(parent, str):
+            raise JiraExportError("'parent' must be an issue key")
+        issue_type = issue_type or (JIRA_SUBTASK_TYPE if parent else JIRA_ISSUE_TYPE)
+
+        export = export_id(project, parent, issue_type, items, idempotency_key)
+        fields = [issue_fields(project, parent, issue_type, item, export, n) for n, item in enumerate(items)]
+        client = self.client()
+        self._count('exports')
+
+        # Issues from an earlier attempt at this export (e.g. the client retried after a timeout)
+        results = {n: {'key': key, 'status': 'existing'} for n, key in self._existing(client, export, len(items)).items()}
+        pending = [n for n in range(len(items)) if n not in results]
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+
+        if len(batches) == 1:
+            results.update(self._create_batch(client, export, fields, batches[0]))
+        elif batches:
+            with ThreadPoolExecutor(max_workers=min(self.max_parallel, len(batches))) as pool:
+                for batch_results in pool.map(lambda batch: self._create_batch(client, export, fields, batch), batches):
+                    results.update(batch_results)
+
+        issues = [dict(results[n], index=n) for n in range(len(items))]
+        for issue in issues:
+            self._count(issue['status'] if issue['status'] != 'error' else 'failed')
+        return {'export_id': export, 'issues': issues}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['configured'] = bool(self.server)
+        return stats
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    # Item index -> issue key for the issues this export already created:
+    # those recorded locally, then the rest from a label search, a page at a
+    # time. Searching is safe to repeat, so each page is simply retried.
+    def _existing(self, client, export, limit):
+        try:
+            existing = self.records.find(export)
+        except sqlite3.Error as e:
+            print("Jira export %s records could not be read: %s" % (export, e), flush=True)
+            existing = {}
+        if len(existing) >= limit:
+            return existing
+
+        found = []
+        start = 0
+        while True:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self._count('api_calls')
+                    page = client.search_issues('labels = "%s%s"' % (LABEL_PREFIX, export), startAt=start,
+                                                maxResults=SEARCH_PAGE_SIZE, fields='labels', json_result=True)
+                    break
+                except Exception as e:
+                    self._retry_or_raise(export, e, attempt)
+            issues = page.get('issues', [])
+            found.extend(issues)
+            start += len(issues)
+            if not issues or start >= page.get('total', 0):
+                break
+
+        prefix = '%s%s-' % (LABEL_PREFIX, export)
+        for issue in found:
+            for label in issue['fields'].get('labels', []):
+                if label.startswith(prefix) and label[len(prefix):].isdigit():
+                    existing.setdefault(int(label[len(prefix):]), issue['key'])
+        return existing
+
+    # Record the issues a call created, so a retry finds them before Jira's search does
+    def _record(self, export, results):
+        keys = {n: result['key'] for n, result in results.items() if result['key'] is not None}
+        if not keys:
+            return
+        try:
+            self.records.save(export, keys)
+        except sqlite3.Error as e:
+            print("Jira export %s could not be recorded: %s" % (export, e), flush=True)
+
+    # Wait before the next attempt, or give up with a 502/503 for the route
+    def _retry_or_raise(self, export, error, attempt):
+        if not is_retryable(error) or attempt == self.max_retries:
+            status = getattr(error, 'status_code', None)
+            print("Jira export %s failed: %s" % (export, error), flush=True)
+            raise UpstreamError("Jira API call failed", status=502 if status and status < 500 else 503)
+        self._count('retries')
+        time.sleep(backoff_delay(attempt, retry_after_seconds(getattr(error, 'response', None))))
+
+    # Bulk-create the items at indexes. A failed call is retried with only the
+    # items Jira doesn't have yet, since the failed call may have created some.
+    def _create_batch(self, client, export, fields, indexes):
+        results = {}
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._count('api_calls')
+                created = client.create_issues([fields[n] for n in indexes], prefetch=False)
+            except Exception as e:
+                self._retry_or_raise(export, e, attempt)
+                existing = self._existing(client, export, len(fields))
+                for n in indexes:
+                    if n in existing:
+                        results[n] = {'key': existing[n], 'status': 'created'}
+                indexes = [n for n in indexes if n not in existing]
+                if not indexes:
+                    break
+                continue
+
+            # Rejected items (bad fields) come back one by one and aren't retried
+            for n, outcome in zip(indexes, created):
+                if outcome['status'] == 'Success':
+                    results[n] = {'key': outcome['issue'].key, 'status': 'created'}
+                else:
+                    results[n] = {'key': None, 'status': 'error', 'error': outcome['error']}
+            break
+        self._record(export, results)
+        return results
+
+
+# Shared exporter for this worker
+jira_exporter = JiraExporter()
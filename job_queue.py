@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+from response_cache import normalize_input
+from prompt_pipeline import ROUTES_BY_PATH, run_route
+from upstream_client import UpstreamError
+
+# Load the .env file
+load_dotenv()
+
+# Job queue settings (can be overridden in the .env file)
+# SQLite file shared by every worker process on the machine
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3'))
+# Background threads running jobs in each worker process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Finished jobs are kept this long for clients to collect
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "3600"))
+# Longest a poll waits for a result; keep it under the gunicorn worker timeout
+JOB_LONG_POLL_MAX = float(os.getenv("JOB_LONG_POLL_MAX", "25"))
+# A running job whose worker went away is picked up again after this long.
+# Workers renew the lease every third of it while the job runs.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# How often idle workers and long polls look at the database again
+POLL_INTERVAL = 0.25
+# How often expired jobs are deleted
+PURGE_INTERVAL = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    dedupe_key TEXT NOT NULL,
+    route TEXT NOT NULL,
+    input_text TEXT NOT NULL,
+    bypass_cache INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    error_status INTEGER,
+    created REAL NOT NULL,
+    finished REAL,
+    expires REAL,
+    lease_until REAL,
+    lease_owner TEXT
+);
+-- Identical jobs share one row while it is queued or running
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending ON jobs (dedupe_key) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+"""
+
+
+# Raised for a job submission that can't be run (the route answers 400)
+class JobError(ValueError):
+    pass
+
+
+def dedupe_key(route_path, input_text, bypass_cache):
+    payload = json.dumps([route_path, normalize_input(input_text), bool(bypass_cache)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# Run the generation for a job the same way the route would, minus streaming
+def run_job(route_path, input_text, bypass_cache):
+    payload, _ = run_route(ROUTES_BY_PATH[route_path], input_text, bypass_cache, False)
+    return payload
+
+
+# Persistent queue of generation jobs. Jobs live in SQLite, so they survive
+# a worker being killed: a running job's lease runs out and another worker
+# picks it up. Clients get a job ID straight away and poll for the result.
+class JobQueue:
+    def __init__(self, handler=run_job, db_path=JOB_DB_PATH, workers=JOB_WORKERS, ttl=JOB_TTL_SECONDS,
+                 lease=JOB_LEASE_SECONDS):
+        self.handler = handler
+        self.db_path = db_path
+        self.workers = workers
+        self.ttl = ttl
+        self.lease = lease
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+        self._last_purge = 0.0
+
+    # Queue a generation, or join the identical one already queued or running.
+    # Returns the job.
+    def submit(self, route_path, input_text, bypass_cache=False):
+        if route_path not in ROUTES_BY_PATH:
+            raise JobError("Unknown route: %s" % route_path)
+        if not isinstance(input_text, str):
+            raise JobError("Job needs a string 'inputText'")
+        self.start()
+
+        key = dedupe_key(route_path, input_text, bypass_cache)
+        db = self._db()
+        while True:
+            existing = db.execute(
+                "SELECT * FROM jobs WHERE dedupe_key = ? AND status IN (?, ?)", (key, QUEUED, RUNNING)).fetchone()
+            if existing is not None:
+                return self._job(existing)
+            job_id = uuid.uuid4().hex
+            try:
+                with db:
+                    db.execute(
+                        "INSERT INTO jobs (id, dedupe_key, route, input_text, bypass_cache, status, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (job_id, key, route_path, input_text, int(bool(bypass_cache)), QUEUED, time.time()))
+                break
+            except sqlite3.IntegrityError:
+                # Another worker queued the same job just now: join it
+                continue
+        with self._cond:
+            self._cond.notify_all()
+        return self.get(job_id)
+
+    # The job, or None if there is no such job (or it has expired)
+    def get(self, job_id):
+        self.start()
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (row['expires'] is not None and row['expires'] < time.time()):
+            return None
+        return self._job(row)
+
+    # Wait up to timeout seconds for the job to finish. Returns it either way.
+    def wait(self, job_id, timeout):
+        deadline = time.monotonic() + min(max(timeout, 0.0), JOB_LONG_POLL_MAX)
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] in (DONE, FAILED) or remaining <= 0:
+                return job
+            # Woken early by a local worker; jobs run by other processes are seen on the next look
+            with self._cond:
+                self._cond.wait(min(remaining, POLL_INTERVAL))
+
+    def stats(self):
+        self.start()
+        rows = self._db().execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        stats = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        stats.update({row['status']: row['count'] for row in rows})
+        stats['workers'] = len(self._threads)
+        return stats
+
+    # One connection per thread (and per process, since gunicorn forks)
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            # Files made before leases had owners
+            if 'lease_owner' not in [column[1] for column in db.execute("PRAGMA table_info(jobs)")]:
+                db.execute("ALTER TABLE jobs ADD COLUMN lease_owner TEXT")
+            db.isolation_level = 'IMMEDIATE'
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _job(self, row):
+        job = {
+            'job_id': row['id'],
+            'route': row['route'],
+            'status': row['status'],
+            'created': row['created'],
+            'finished': row['finished'],
+        }
+        if row['status'] == DONE:
+            job['result'] = json.loads(row['result'])
+        elif row['status'] == FAILED:
+            job['error'] = row['error']
+            job['error_status'] = row['error_status']
+        return job
+
+    # Start the worker threads. Called when the app loads and again on every
+    # use, so each gunicorn worker gets its own after fork and jobs left
+    # queued by a restart are picked up without waiting for a new submission.
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._threads = []
+                for n in range(self.workers):
+                    thread = threading.Thread(target=self._run, name='job-worker-%d' % n, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+                self._pid = os.getpid()
+
+    # Take the oldest queued job, or a running one whose lease ran out.
+    # Returns the row and this claim's lease owner token, or (None, None).
+    def _claim(self):
+        now = time.time()
+        owner = uuid.uuid4().hex
+        db = self._db()
+        with db:
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY created LIMIT 1",
+                (QUEUED, RUNNING, now)).fetchone()
+            if row is None:
+                return None, None
+            # Only if nobody claimed or renewed it since the SELECT
+            claimed = db.execute(
+                "UPDATE jobs SET status = ?, lease_until = ?, lease_owner = ? "
+                "WHERE id = ? AND (status = ? OR (status = ? AND lease_until < ?))",
+                (RUNNING, now + self.lease, owner, row['id'], QUEUED, RUNNING, now)).rowcount
+        if not claimed:
+            return None, None
+        return row, owner
+
+    # Renew the lease while the job runs, so a slow generation isn't taken
+    # for an abandoned one and run a second time
+    def _heartbeat(self, job_id, owner, done):
+        while not done.wait(self.lease / 3):
+            try:
+                db = self._db()
+                with db:
+                    db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND lease_owner = ?",
+                               (time.time() + self.lease, job_id, owner))
+            except sqlite3.Error as e:
+                print("Job queue error: %s" % e, flush=True)
+
+    # Store the outcome, unless the lease was lost and another worker owns the job now
+    def _finish(self, job_id, owner, status, result=None, error=None, error_status=None):
+        now = time.time()
+        db = self._db()
+        with db:
+            updated = db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, error_status = ?, finished = ?, expires = ?, "
+                "lease_until = NULL, lease_owner = NULL WHERE id = ? AND lease_owner = ?",
+                (status, result, error, error_status, now, now + self.ttl, job_id, owner)).rowcount
+        if not updated:
+            print("Job %s lost its lease, dropping this result" % job_id, flush=True)
+        with self._cond:
+            self._cond.notify_all()
+
+    def _purge(self):
+        now = time.time()
+        if now - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM jobs WHERE expires IS NOT NULL AND expires < ?", (now,))
+
+    def _run(self):
+        while True:
+            try:
+                self._purge()
+                row, owner = self._claim()
+            except sqlite3.Error as e:
+                print("Job queue error: %s" % e, flush=True)
+                row = None
+            if row is None:
+                with self._cond:
+                    self._cond.wait(POLL_INTERVAL)
+                continue
+
+            done = threading.Event()
+            threading.Thread(target=self._heartbeat, args=(row['id'], owner, done), daemon=True).start()
+            try:
+                try:
+                    payload = self.handler(row['route'], row['input_text'], bool(row['bypass_cache']))
+                except UpstreamError as e:
+                    self._finish(row['id'], owner, FAILED, error=str(e), error_status=e.status)
+                except Exception as e:
+                    print("Job %s failed: %r" % (row['id'], e), flush=True)
+                    self._finish(row['id'], owner, FAILED, error="Job failed", error_status=500)
+                else:
+                    self._finish(row['id'], owner, DONE, result=json.dumps(payload))
+            except sqlite3.Error as e:
+                # The lease runs out and the job is picked up again
+                print("Job queue error: %s" % e, flush=True)
+            finally:
+                done.set()
+
+
+# Shared queue for this worker
+job_queue = JobQueue()
@@ -1,14 +1,11 @@
 import numpy as np
-import pandas as pd
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
+from dataset import load_salary_data
 
-# Load the data from CSV file
-data = pd.read_csv('./data/Data.csv')
-
-# Extract input features (Age and Weight) and target variable (Salary)
-X = data[['Age', 'Weight']]
-y = data['Salary']
+# Load the input features (Age and Weight) and target variable (Salary) from
+# the CSV, through the columnar cache so it is only parsed when it changes
+X, y = load_salary_data('./data/Data.csv')
 
 # Split the data into training and testing sets
 X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
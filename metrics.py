@@ -0,0 +1,160 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load the .env file
+load_dotenv()
+
+# Print one JSON line per request with its timings and token usage
+METRICS_LOG_JSON = os.getenv("METRICS_LOG_JSON", "").strip().lower() in ('1', 'true', 'yes')
+
+# Histogram buckets for durations (seconds) and token counts
+SECONDS_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (25, 50, 100, 200, 400, 600, 800, 1000, 1500, 2000, 4000, 8000)
+# Buckets for micro-batch sizes (rows) and how full the batches were
+ROW_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+# Histograms exported on /metrics, with their help text and buckets
+HISTOGRAMS = {
+    'request_seconds': ("Total time spent handling the request", SECONDS_BUCKETS),
+    'parse_seconds': ("Time spent reading the request body", SECONDS_BUCKETS),
+    'prompt_build_seconds': ("Time spent preprocessing the input and building the prompt and cache key", SECONDS_BUCKETS),
+    'upstream_seconds': ("Time spent waiting on the OpenAI API", SECONDS_BUCKETS),
+    'serialize_seconds': ("Time spent serialising the JSON response", SECONDS_BUCKETS),
+    'prompt_tokens': ("Prompt tokens reported by the OpenAI API", TOKEN_BUCKETS),
+    'completion_tokens': ("Completion tokens reported by the OpenAI API", TOKEN_BUCKETS),
+    'context_tokens': ("Input tokens sent after context compaction", TOKEN_BUCKETS),
+    'batch_rows': ("Rows scored per micro-batch", ROW_BUCKETS),
+    'batch_fill_ratio': ("Micro-batch rows as a fraction of the batch size", RATIO_BUCKETS),
+}
+
+# Counters exported on /metrics, with their help text
+COUNTERS = {
+    'requests_total': "Requests handled, by route and HTTP status",
+    'cache_total': "Completion lookups, by route and cache status",
+}
+
+METRIC_PREFIX = 'pmai_'
+
+# Record for the request being handled, used for the JSON log line
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# In-process metrics registry. Each gunicorn worker keeps its own, so scrape
+# every worker (or run one worker per container) to see the whole picture.
+class Metrics:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, route, value):
+        with self._lock:
+            histogram = self._histograms.get((name, route))
+            if histogram is None:
+                histogram = self._histograms[(name, route)] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+        # Keep the per-request record for the JSON log line
+        record = current_request.get()
+        if record is not None:
+            record[name] = round(record.get(name, 0) + value, 6)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timed(self, name, route):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, route, time.perf_counter() - start)
+
+    def count_cache(self, route, cache_status):
+        self.inc('cache_total', {'route': route, 'status': cache_status})
+        record = current_request.get()
+        if record is not None:
+            record['cache'] = cache_status
+
+    def record_usage(self, route, response):
+        usage = response.get('usage') or {}
+        for name in ('prompt_tokens', 'completion_tokens'):
+            if usage.get(name) is not None:
+                self.observe(name, route, usage[name])
+
+    # Render every metric in the Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            metric = METRIC_PREFIX + name
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s histogram' % metric)
+            for (hist_name, route), (counts, total, count) in sorted(histograms.items()):
+                if hist_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket{route="%s",le="%s"} %d' % (metric, route, bound, cumulative))
+                lines.append('%s_sum{route="%s"} %s' % (metric, route, repr(round(total, 6))))
+                lines.append('%s_count{route="%s"} %d' % (metric, route, count))
+
+        for name, help_text in COUNTERS.items():
+            metric = METRIC_PREFIX + name
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s counter' % metric)
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name != name:
+                    continue
+                label_text = ','.join('%s="%s"' % (key, val) for key, val in labels)
+                lines.append('%s{%s} %d' % (metric, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+    # Start tracking a request. Returns the context token for finish_request().
+    def start_request(self, route):
+        return current_request.set({'route': route, 'start': time.perf_counter()})
+
+    def finish_request(self, token, status):
+        record = current_request.get()
+        current_request.reset(token)
+        if record is None:
+            return
+        elapsed = time.perf_counter() - record.pop('start')
+        route = record['route']
+        self.observe('request_seconds', route, elapsed)
+        self.inc('requests_total', {'route': route, 'status': str(status)})
+
+        if METRICS_LOG_JSON:
+            record['request_seconds'] = round(elapsed, 6)
+            record['status'] = status
+            print(json.dumps(record), flush=True)
+
+
+# Shared registry for this worker
+metrics = Metrics()
@@ -0,0 +1,136 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+from dotenv import load_dotenv
+from metrics import metrics
+
+# Load the .env file
+load_dotenv()
+
+# Batching settings (can be overridden in the .env file)
+# How long a batch waits for more requests to join it. Only used while other
+# predictions are in flight; a request on its own is scored straight away.
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "2"))
+# A batch is scored as soon as it has this many rows
+MICRO_BATCH_MAX_ROWS = int(os.getenv("MICRO_BATCH_MAX_ROWS", "256"))
+# Requests allowed to wait for a batch before new ones are turned away
+MICRO_BATCH_QUEUE_SIZE = int(os.getenv("MICRO_BATCH_QUEUE_SIZE", "1024"))
+
+
+# Raised when the batch queue is full (the route answers 503)
+class BatchQueueFullError(Exception):
+    pass
+
+
+# A request waiting for its rows to be scored
+class PendingPrediction:
+    def __init__(self, features):
+        self.features = features
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Collects small prediction requests that arrive close together, scores them
+# with one matrix predict call and hands each request its own rows back
+class MicroBatcher:
+    def __init__(self, predict_fn, max_wait_ms=MICRO_BATCH_WAIT_MS, max_rows=MICRO_BATCH_MAX_ROWS,
+                 queue_size=MICRO_BATCH_QUEUE_SIZE, metrics_route='/predict'):
+        self.predict_fn = predict_fn
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_rows = max_rows
+        self.metrics_route = metrics_route
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        # Requests queued or on their way to the queue, not yet scored
+        self._active = 0
+        self.counters = {'batches': 0, 'rows': 0, 'requests': 0, 'direct': 0, 'rejected': 0}
+
+    def predict(self, features):
+        # Requests that already fill a batch gain nothing from waiting
+        if len(features) >= self.max_rows:
+            with self._lock:
+                self.counters['direct'] += 1
+            return self.predict_fn(features)
+
+        self._ensure_thread()
+        pending = PendingPrediction(features)
+        with self._lock:
+            self._active += 1
+        try:
+            self._queue.put_nowait(pending)
+        except queue.Full:
+            with self._lock:
+                self._active -= 1
+                self.counters['rejected'] += 1
+            raise BatchQueueFullError("Too many predictions waiting, try again shortly")
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['queued'] = self._queue.qsize()
+        stats['mean_fill'] = round(stats['rows'] / (stats['batches'] * self.max_rows), 3) if stats['batches'] else None
+        stats['max_rows'] = self.max_rows
+        stats['max_wait_ms'] = self.max_wait * 1000
+        return stats
+
+    # Start the batching thread on first use, so each gunicorn worker gets its own after fork
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            rows = len(batch[0].features)
+
+            # Keep collecting until the batch is full or the window closes,
+            # as long as other predictions are in flight to join it; with
+            # none (always the case in a sync worker) score it now
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_rows and self._active > len(batch):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                rows += len(pending.features)
+
+            self._score(batch, rows)
+
+    def _score(self, batch, rows):
+        try:
+            features = np.concatenate([pending.features for pending in batch])
+            predicted = self.predict_fn(features)
+            # Hand each request back its own slice of the predictions
+            offset = 0
+            for pending in batch:
+                pending.result = predicted[offset:offset + len(pending.features)]
+                offset += len(pending.features)
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        finally:
+            with self._lock:
+                self._active -= len(batch)
+                self.counters['batches'] += 1
+                self.counters['rows'] += rows
+            for pending in batch:
+                pending.done.set()
+            self.counters['requests'] += len(batch)
+        metrics.observe('batch_rows', self.metrics_route, rows)
+        metrics.observe('batch_fill_ratio', self.metrics_route, min(rows / self.max_rows, 1.0))
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import re
+import time
+import numpy as np
+from dotenv import load_dotenv
+
+# Load the .env file
+load_dotenv()
+
+# Versioned store for the salary model weights. Each version is a directory
+# with weights.npy and metadata.json; "current" is a symlink to the version
+# being served and is switched with a rename, so readers always see either
+# the old or the new version, never a mix.
+#
+#   models/
+#     v0001/weights.npy, metadata.json
+#     v0002/...
+#     current -> v0002
+#
+# List and roll back with: python model_registry.py list / activate v0001
+MODEL_REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'))
+
+CURRENT_LINK = 'current'
+WEIGHTS_FILE = 'weights.npy'
+METADATA_FILE = 'metadata.json'
+VERSION_PATTERN = re.compile(r'^v(\d+)$')
+
+
+# Raised for a version that doesn't exist in the registry
+class UnknownVersionError(LookupError):
+    pass
+
+
+def list_versions(registry_dir=MODEL_REGISTRY_DIR):
+    if not os.path.isdir(registry_dir):
+        return []
+    versions = [name for name in os.listdir(registry_dir) if VERSION_PATTERN.match(name)]
+    return sorted(versions, key=lambda name: int(VERSION_PATTERN.match(name).group(1)))
+
+
+# Version "current" points at, or None if nothing has been published yet.
+# One readlink, cheap enough to call on every request.
+def current_version(registry_dir=MODEL_REGISTRY_DIR):
+    try:
+        return os.readlink(os.path.join(registry_dir, CURRENT_LINK))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+# Point "current" at a version (also how to roll back)
+def activate(version, registry_dir=MODEL_REGISTRY_DIR):
+    if not os.path.isfile(os.path.join(registry_dir, version, WEIGHTS_FILE)):
+        raise UnknownVersionError("No model version %s in %s" % (version, registry_dir))
+    tmp_link = os.path.join(registry_dir, '.%s.%d.tmp' % (CURRENT_LINK, os.getpid()))
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, os.path.join(registry_dir, CURRENT_LINK))
+
+
+# Store weights and metadata as the next version and, unless activate is
+# False, make it current. The version directory is filled under a temporary
+# name and renamed into place, so a half-written version is never visible.
+def publish(weights, metadata, registry_dir=MODEL_REGISTRY_DIR, activate_version=True):
+    os.makedirs(registry_dir, exist_ok=True)
+    tmp_dir = os.path.join(registry_dir, '.publish.%d.tmp' % os.getpid())
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, WEIGHTS_FILE), np.ascontiguousarray(weights, dtype=np.float64))
+
+    existing = list_versions(registry_dir)
+    number = int(VERSION_PATTERN.match(existing[-1]).group(1)) + 1 if existing else 1
+    while True:
+        version = 'v%04d' % number
+        metadata = dict(metadata, version=version, published_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+        with open(os.path.join(tmp_dir, METADATA_FILE), 'w') as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+        try:
+            os.rename(tmp_dir, os.path.join(registry_dir, version))
+            break
+        except OSError:
+            # Another trainer took this number first
+            if not os.path.exists(os.path.join(registry_dir, version)):
+                raise
+            number += 1
+
+    if activate_version:
+        activate(version, registry_dir)
+    return version
+
+
+# Load a version's weights memory-mapped (read-only, so every worker shares
+# one copy in the page cache) along with its metadata
+def load(version, registry_dir=MODEL_REGISTRY_DIR):
+    version_dir = os.path.join(registry_dir, version)
+    try:
+        weights = np.load(os.path.join(version_dir, WEIGHTS_FILE), mmap_mode='r', allow_pickle=False)
+        with open(os.path.join(version_dir, METADATA_FILE)) as f:
+            metadata = json.load(f)
+    except FileNotFoundError as e:
+        raise UnknownVersionError("No model version %s in %s" % (version, registry_dir)) from e
+    return weights, metadata
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="List or switch the served salary model version")
+    parser.add_argument('--registry', default=MODEL_REGISTRY_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help="show every version and which one is current")
+    activate_parser = commands.add_parser('activate', help="serve a version (e.g. to roll back)")
+    activate_parser.add_argument('version')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        current = current_version(args.registry)
+        for version in list_versions(args.registry):
+            marker = '*' if version == current else ' '
+            try:
+                _, metadata = load(version, args.registry)
+            except (UnknownVersionError, ValueError, OSError) as e:
+                print('%s %s unreadable: %s' % (marker, version, e))
+                continue
+            print('%s %s mse=%s rows=%s trained_at=%s' % (
+                marker, version, metadata.get('mse'), metadata.get('rows'), metadata.get('trained_at')))
+    else:
+        try:
+            activate(args.version, args.registry)
+        except UnknownVersionError as e:
+            parser.error(str(e))
+        print("Now serving", args.version)
@@ -0,0 +1,177 @@
+import collections
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from upstream_client import UpstreamError, CircuitOpenError
+
+# Load the .env file
+load_dotenv()
+
+# Model routing settings (can be overridden in the .env file)
+# Each tier lists its primary model first, then the fallbacks in order
+MODEL_TIER_QUALITY = os.getenv("MODEL_TIER_QUALITY", "gpt-4,gpt-3.5-turbo")
+MODEL_TIER_FAST = os.getenv("MODEL_TIER_FAST", "gpt-3.5-turbo,gpt-4")
+# Move routes between tiers without a deploy, e.g. "/tasks=fast,/whats-next=fast"
+MODEL_ROUTE_TIERS = os.getenv("MODEL_ROUTE_TIERS", "")
+# Calls remembered per route and model, for this many seconds
+MODEL_STATS_WINDOW = float(os.getenv("MODEL_STATS_WINDOW", "300"))
+# A model needs this many calls in the window before it can be failed over
+MODEL_MIN_SAMPLES = int(os.getenv("MODEL_MIN_SAMPLES", "10"))
+# Fail over when the error rate or p95 latency passes these
+MODEL_MAX_ERROR_RATE = float(os.getenv("MODEL_MAX_ERROR_RATE", "0.25"))
+MODEL_P95_TARGET = float(os.getenv("MODEL_P95_TARGET", "20"))
+# Answers from a fallback model are cached this long, under their own key
+MODEL_FALLBACK_CACHE_TTL = float(os.getenv("MODEL_FALLBACK_CACHE_TTL", "300"))
+
+TIER_QUALITY = 'quality'
+TIER_FAST = 'fast'
+
+
+def parse_models(value):
+    return tuple(model.strip() for model in value.split(',') if model.strip())
+
+def parse_route_tiers(value):
+    tiers = {}
+    for pair in value.split(','):
+        if '=' in pair:
+            path, tier = pair.split('=', 1)
+            tiers[path.strip()] = tier.strip()
+    return tiers
+
+
+# Calls to one model on one route over the last window seconds
+class ModelStats:
+    def __init__(self, window):
+        self.window = window
+        self.calls = collections.deque()
+
+    def record(self, now, seconds, ok):
+        self.calls.append((now, seconds, ok))
+        self._prune(now)
+
+    def snapshot(self, now):
+        self._prune(now)
+        latencies = sorted(seconds for _, seconds, ok in self.calls if ok)
+        errors = sum(1 for _, _, ok in self.calls if not ok)
+        samples = len(self.calls)
+        return {
+            'samples': samples,
+            'error_rate': round(errors / samples, 3) if samples else 0.0,
+            'p50': latencies[len(latencies) // 2] if latencies else None,
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+        }
+
+    def _prune(self, now):
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+
+
+# Picks the model for each route from its tier: the first model in the tier
+# that is healthy on that route. A model is unhealthy once it has enough
+# recent calls and its error rate or p95 latency is over the limit. Its
+# calls age out of the window after failover, so the primary gets tried
+# again once the window has passed.
+class ModelRouter:
+    def __init__(self, tiers=None, route_tiers=None, window=MODEL_STATS_WINDOW, min_samples=MODEL_MIN_SAMPLES,
+                 max_error_rate=MODEL_MAX_ERROR_RATE, p95_target=MODEL_P95_TARGET):
+        self.tiers = tiers or {TIER_QUALITY: parse_models(MODEL_TIER_QUALITY), TIER_FAST: parse_models(MODEL_TIER_FAST)}
+        self.route_tiers = parse_route_tiers(MODEL_ROUTE_TIERS) if route_tiers is None else route_tiers
+        for path, tier in list(self.route_tiers.items()):
+            if tier not in self.tiers:
+                print("Ignoring unknown model tier %r for %s" % (tier, path), flush=True)
+                del self.route_tiers[path]
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.p95_target = p95_target
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.counters = {'fallback_calls': 0}
+
+    def tier(self, route):
+        return self.route_tiers.get(route.path, route.tier)
+
+    def models(self, route):
+        return self.tiers[self.tier(route)]
+
+    # The primary model, used in cache keys so failover doesn't empty the cache
+    def primary(self, route):
+        return self.models(route)[0]
+
+    def choose(self, route):
+        model = self.current(route)
+        if model != self.primary(route):
+            with self._lock:
+                self.counters['fallback_calls'] += 1
+        return model
+
+    # The model calls for the route go to right now, without counting a call
+    def current(self, route):
+        models = self.models(route)
+        now = time.monotonic()
+        with self._lock:
+            for model in models:
+                if self._healthy(route, model, now):
+                    return model
+        # Everything is struggling: stay on the primary
+        return models[0]
+
+    def record(self, route, model, seconds, ok):
+        with self._lock:
+            stats = self._stats.get((route.path, model))
+            if stats is None:
+                stats = self._stats[(route.path, model)] = ModelStats(self.window)
+            stats.record(time.monotonic(), seconds, ok)
+
+    # Time an upstream call and record it against the model. Bad requests
+    # (502) and calls the circuit breaker refused say nothing about the model.
+    @contextmanager
+    def timed(self, route, model):
+        start = time.monotonic()
+        try:
+            yield
+        except UpstreamError as e:
+            if e.status != 502 and not isinstance(e, CircuitOpenError):
+                self.record(route, model, time.monotonic() - start, False)
+            raise
+        self.record(route, model, time.monotonic() - start, True)
+
+    # Routing table for operators: each route's tier, models and the one in use
+    def table(self, routes):
+        now = time.monotonic()
+        table = {}
+        with self._lock:
+            for route in routes:
+                models = self.models(route)
+                chosen = next((model for model in models if self._healthy(route, model, now)), models[0])
+                table[route.path] = {
+                    'tier': self.tier(route),
+                    'models': list(models),
+                    'chosen': chosen,
+                    'p95_target': self._p95_target(route),
+                    'stats': {
+                        model: dict(self._stats[(route.path, model)].snapshot(now), healthy=self._healthy(route, model, now))
+                        for model in models if (route.path, model) in self._stats
+                    },
+                }
+        return {'routes': table, 'fallback_calls': self.counters['fallback_calls']}
+
+    def _p95_target(self, route):
+        return route.latency_target or self.p95_target
+
+    def _healthy(self, route, model, now):
+        stats = self._stats.get((route.path, model))
+        if stats is None:
+            return True
+        snapshot = stats.snapshot(now)
+        if snapshot['samples'] < self.min_samples:
+            return True
+        if snapshot['error_rate'] > self.max_error_rate:
+            return False
+        return snapshot['p95'] is None or snapshot['p95'] <= self._p95_target(route)
+
+
+# Shared router for this worker
+router = ModelRouter()
@@ -0,0 +1,138 @@
+import collections
+import os
+import re
+import threading
+import zlib
+import numpy as np
+from dotenv import load_dotenv
+
+# Load the .env file
+load_dotenv()
+
+# Near-duplicate input settings (can be overridden in the .env file)
+# Routes whose inputs are indexed, e.g. "/openai-predict,/openai-solution"
+NEAR_DUP_ROUTES = os.getenv("NEAR_DUP_ROUTES", "/openai-predict")
+# Estimated Jaccard similarity (of character shingles) that counts as the same input
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.9"))
+# Answer near-duplicates with the earlier completion. Off by default, since
+# lexically close inputs can still mean different things ("don't do X" vs
+# "do X"): matches are only offered through POST /similar and the route
+# generates as usual.
+NEAR_DUP_SERVE = os.getenv("NEAR_DUP_SERVE", "").strip().lower() in ('1', 'true', 'yes')
+# Inputs remembered across all routes; the least recently used go first
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", "4096"))
+
+# MinHash signature length, split into LSH bands of NUM_PERM / BANDS rows.
+# 16 bands of 4 rows make inputs above about 0.5 similarity candidates,
+# which are then checked against the threshold.
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_CHARS = 5
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+NON_WORD = re.compile(r'[\W_]+')
+
+
+def parse_routes(value):
+    return frozenset(path.strip() for path in value.split(',') if path.strip())
+
+
+# Overlapping character runs of the input with case and punctuation dropped,
+# so edits only change the shingles around them
+def shingles(text):
+    text = NON_WORD.sub(' ', text.lower()).strip()
+    if len(text) <= SHINGLE_CHARS:
+        return {text}
+    return {text[i:i + SHINGLE_CHARS] for i in range(len(text) - SHINGLE_CHARS + 1)}
+
+
+# Finds earlier inputs to a route that are near-duplicates of a new one,
+# with MinHash signatures bucketed by LSH band. Entries hold the signature
+# and the response cache key of the earlier input, not the completion, so
+# memory is bounded by max_entries; the completion is read from the cache.
+class NearDuplicateIndex:
+    def __init__(self, routes=None, threshold=NEAR_DUP_THRESHOLD, max_entries=NEAR_DUP_MAX_ENTRIES,
+                 num_perm=NUM_PERM, bands=BANDS, seed=1):
+        self.routes = parse_routes(NEAR_DUP_ROUTES) if routes is None else frozenset(routes)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.RandomState(seed)
+        # a * hash stays below 2^61 (hashes are 32-bit), so a * hash + b
+        # never wraps in uint64 before the mod
+        self._a = rng.randint(1, 1 << 29, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        # Cache key -> (route path, signature, band bucket keys), oldest first
+        self._entries = collections.OrderedDict()
+        # (route path, band, band values) -> cache keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.counters = {'queries': 0, 'matches': 0, 'evictions': 0}
+
+    def covers(self, route):
+        return route.path in self.routes
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles(text)), dtype=np.uint64)
+        # One universal hash per permutation, minimum over the shingles
+        permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME & MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def add(self, route, text, key):
+        signature = self.signature(text)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            bucket_keys = self._bucket_keys(route.path, signature)
+            for bucket_key in bucket_keys:
+                self._buckets.setdefault(bucket_key, set()).add(key)
+            self._entries[key] = (route.path, signature, bucket_keys)
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    # Earlier inputs to this route at least threshold similar, as
+    # (similarity, cache key), most similar first
+    def query(self, route, text, exclude=None):
+        signature = self.signature(text)
+        with self._lock:
+            self.counters['queries'] += 1
+            candidates = set()
+            for bucket_key in self._bucket_keys(route.path, signature):
+                candidates.update(self._buckets.get(bucket_key, ()))
+            candidates.discard(exclude)
+            matches = []
+            for key in candidates:
+                similarity = float(np.mean(self._entries[key][1] == signature))
+                if similarity >= self.threshold:
+                    matches.append((round(similarity, 3), key))
+            if matches:
+                self.counters['matches'] += 1
+        return sorted(matches, reverse=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._entries)
+            stats['buckets'] = len(self._buckets)
+        stats['max_entries'] = self.max_entries
+        stats['threshold'] = self.threshold
+        stats['routes'] = sorted(self.routes)
+        return stats
+
+    def _bucket_keys(self, route_path, signature):
+        return [(route_path, band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    def _evict(self):
+        key, (_, _, bucket_keys) = self._entries.popitem(last=False)
+        for bucket_key in bucket_keys:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[bucket_key]
+        self.counters['evictions'] += 1
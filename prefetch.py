@@ -0,0 +1,170 @@
+import collections
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from rate_limiter import TokenBucket
+from upstream_client import UpstreamError
+
+# Load the .env file
+load_dotenv()
+
+# Speculative prefetch settings (can be overridden in the .env file)
+# Off unless turned on, since every guess costs OpenAI tokens
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "").strip().lower() in ('1', 'true', 'yes')
+# Background threads running guesses, and guesses allowed to wait for one
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+PREFETCH_QUEUE_SIZE = int(os.getenv("PREFETCH_QUEUE_SIZE", "32"))
+# Items of a finished stage to guess on
+PREFETCH_MAX_ITEMS = int(os.getenv("PREFETCH_MAX_ITEMS", "5"))
+# Token budget per minute for guesses, on top of the scheduler's quota
+PREFETCH_TPM = int(os.getenv("PREFETCH_TPM", "20000"))
+# Guesses still queued after this many seconds are dropped
+PREFETCH_MAX_AGE = float(os.getenv("PREFETCH_MAX_AGE", "120"))
+
+# How many prefetched keys to remember for the hit counter
+RECENT_KEYS = 1024
+
+
+# One guessed completion: a route, its input and the cache key it will fill
+class PrefetchJob:
+    def __init__(self, route, input_text, key, cost):
+        self.route = route
+        self.input_text = input_text
+        self.key = key
+        self.cost = cost
+        self.created = time.monotonic()
+        # Every job guessed from the same finished stage
+        self.batch = None
+        self.started = False
+        self.cancelled = False
+
+
+# Runs guessed completions for the likely next stage in the background so
+# they are in the response cache before the user clicks. When the user picks
+# one item, the guesses still queued for its siblings are cancelled.
+class Prefetcher:
+    def __init__(self, fetch_fn, cached_fn, enabled=PREFETCH_ENABLED, workers=PREFETCH_WORKERS,
+                 queue_size=PREFETCH_QUEUE_SIZE, tpm=PREFETCH_TPM, max_age=PREFETCH_MAX_AGE):
+        # fetch_fn(route, input_text) fills the cache; cached_fn(key) checks it
+        self.fetch_fn = fetch_fn
+        self.cached_fn = cached_fn
+        self.enabled = enabled and workers > 0
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_age = max_age
+        self.budget = TokenBucket(tpm)
+        self._queue = collections.deque()
+        # Queued and running jobs by cache key
+        self._jobs = {}
+        self._recent = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._threads = []
+        self.counters = {
+            'scheduled': 0, 'completed': 0, 'already_cached': 0, 'hits': 0,
+            'cancelled': 0, 'expired': 0, 'dropped': 0, 'over_budget': 0, 'failed': 0,
+        }
+
+    # Queue guesses that belong together (one finished stage). Guesses that
+    # don't fit in the queue are dropped rather than waited for.
+    def schedule(self, jobs):
+        if not self.enabled or not jobs:
+            return
+        self._ensure_threads()
+        with self._cond:
+            batch = [job for job in jobs if job.key not in self._jobs]
+            for job in batch:
+                job.batch = batch
+                if len(self._queue) >= self.queue_size:
+                    self.counters['dropped'] += 1
+                    continue
+                self._queue.append(job)
+                self._jobs[job.key] = job
+                self.counters['scheduled'] += 1
+            self._cond.notify_all()
+
+    # A real request arrived for key. Its siblings won't be clicked now, so
+    # drop their queued guesses. A guess already running for key is left to
+    # finish; the request joins it through single-flight, and the caller
+    # promotes the guess's scheduler ticket to the request's priority.
+    def claim(self, key):
+        if not self.enabled:
+            return
+        with self._cond:
+            if key in self._recent:
+                self.counters['hits'] += 1
+            job = self._jobs.get(key)
+            if job is None:
+                return
+            if job.started:
+                self.counters['hits'] += 1
+            for sibling in job.batch:
+                if not sibling.started and not sibling.cancelled:
+                    sibling.cancelled = True
+                    self._jobs.pop(sibling.key, None)
+                    self.counters['cancelled'] += 1
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counters)
+            stats['queued'] = sum(1 for job in self._queue if not job.cancelled)
+            self.budget.refill(time.monotonic())
+            stats['budget_available'] = int(self.budget.level)
+        stats['enabled'] = self.enabled
+        return stats
+
+    # Start the worker threads on first use, so each gunicorn worker gets its own after fork
+    def _ensure_threads(self):
+        if self._threads:
+            return
+        with self._cond:
+            if not self._threads:
+                for n in range(self.workers):
+                    thread = threading.Thread(target=self._run, name='prefetch-%d' % n, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                if job.cancelled:
+                    continue
+                if time.monotonic() - job.created > self.max_age:
+                    self._jobs.pop(job.key, None)
+                    self.counters['expired'] += 1
+                    continue
+                self.budget.refill(time.monotonic())
+                if self.budget.level < job.cost:
+                    self._jobs.pop(job.key, None)
+                    self.counters['over_budget'] += 1
+                    continue
+                self.budget.level -= job.cost
+                job.started = True
+                return job
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            outcome = 'completed'
+            try:
+                if self.cached_fn(job.key):
+                    outcome = 'already_cached'
+                else:
+                    self.fetch_fn(job.route, job.input_text)
+            except UpstreamError as e:
+                # Includes being shed by the scheduler: guesses never retry
+                outcome = 'failed'
+                print("Prefetch for %s failed: %s" % (job.route.path, e), flush=True)
+            except Exception as e:
+                outcome = 'failed'
+                print("Prefetch for %s failed: %r" % (job.route.path, e), flush=True)
+            with self._cond:
+                self._jobs.pop(job.key, None)
+                self.counters[outcome] += 1
+                if outcome == 'completed':
+                    self._recent[job.key] = True
+                    while len(self._recent) > RECENT_KEYS:
+                        self._recent.popitem(last=False)
@@ -0,0 +1,580 @@
+import asyncio
+import contextvars
+import json
+import openai
+from response_cache import response_cache, make_key
+from upstream_client import upstream, UpstreamError
+from single_flight import single_flight
+from metrics import metrics
+from rate_limiter import scheduler, estimate_cost, PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK, PRIORITY_SPECULATIVE
+from prefetch import Prefetcher, PrefetchJob, PREFETCH_MAX_ITEMS
+from context_builder import compact, count_tokens, CONTEXT_SUMMARIES_ENABLED, CONTEXT_SUMMARY_TPM
+from model_router import router, TIER_QUALITY, TIER_FAST, MODEL_FALLBACK_CACHE_TTL
+from near_duplicates import NearDuplicateIndex, NEAR_DUP_SERVE
+
+# Error payload returned when the completion has no choices
+NO_CHOICES_ERROR = {'error': "No 'choices' in API response"}
+
+
+# Input preprocessors
+
+# Pass the input text through unchanged
+def keep_input(input_text):
+    return input_text
+
+# Join comma separated items from the previous stages into one sentence
+def join_items(input_text):
+    input_text_list = input_text.split(', ')
+    return ' '.join(input_text_list)
+
+
+# Output shapes
+
+# Split the predicted text into individual items if it's a list
+def split_lines(predicted_text):
+    return predicted_text.split('\n')
+
+# Return the predicted text as a single string (used for code)
+def whole_text(predicted_text):
+    return predicted_text
+
+
+# One entry in the prompt registry
+class PromptRoute:
+    def __init__(self, path, endpoint, prompt_string, max_tokens=200, preprocess=join_items, output=split_lines, stream=False, timeout=None, priority=PRIORITY_NORMAL, context_tokens=None, tier=TIER_QUALITY, latency_target=None):
+        self.path = path
+        self.endpoint = endpoint
+        self.prompt_string = prompt_string
+        self.max_tokens = max_tokens
+        # Token budget for the accumulated input (None sends it as is)
+        self.context_tokens = context_tokens
+        # Model tier (see model_router.py) and the p95 latency in seconds
+        # past which the router fails over (None uses MODEL_P95_TARGET)
+        self.tier = tier
+        self.latency_target = latency_target
+        # Upstream timeout in seconds (None uses UPSTREAM_TIMEOUT)
+        self.timeout = timeout
+        # Scheduling priority when the OpenAI quota is tight
+        self.priority = priority
+        self.preprocess = preprocess
+        self.output = output
+
+        # Long-form routes also get a Server-Sent Events variant at <path>/stream
+        self.stream = stream
+        self.stream_path = path + '/stream'
+
+        # Compile the template once so requests only append the input
+        self.prefix = prompt_string + " "
+
+    def build_prompt(self, input_text):
+        return self.prefix + input_text
+
+    # Worst-case token cost of one completion, used to admit it against the quota
+    def estimate_cost(self, input_text):
+        return estimate_cost(self.build_prompt(input_text), self.max_tokens)
+
+    def messages(self, input_text):
+        return [
+            {"role": "user", "content": self.build_prompt(input_text)},
+        ]
+
+
+# Prompt registry, one entry per POST route in the user flow
+PROMPT_ROUTES = [
+    PromptRoute(
+        '/openai-predict', 'openai_predict',
+        "List 5 high quality problem statements based on the following problem, in a user story format from the agile software development framework. Make each item in the format As a <something>, I want to <do something>, so that <some outcome>. No line breaks. The problem is:",
+        preprocess=keep_input,
+        priority=PRIORITY_INTERACTIVE,
+    ),
+    PromptRoute(
+        '/openai-solution', 'openai_solution',
+        "Given the following user story, generate 5 high-quality acceptance criteria for agile software development. Each criterion should be no more than 100 characters long, in a list format. Only include the list in your response, no other text. The user story is:",
+        preprocess=keep_input,
+        priority=PRIORITY_INTERACTIVE,
+    ),
+    PromptRoute(
+        '/tasks', 'tasks',
+        "Given the following acceptance criteria and technical requirements, provide a list of 10 detailed programming tasks that would be needed to build the digital solution. Each item should be no more than 100 characters long, in a list format. Only include the list in your response, no other text: ",
+    ),
+    PromptRoute(
+        '/targetCustomer', 'targetCustomer',
+        "Based on the following User Story, Acceptance Criteria, Technical Requirement, and Tasks, provide me with the most likely options of my who my target customer is. Each item should be no more than 100 characters long, in a list format. Only include the list in your response, no other text: ",
+    ),
+    PromptRoute(
+        '/dataElements', 'dataElements',
+        "Given the following final problem statement, acceptance criteria, and target market, list for me the 5 important data metrics to consider for my feature. Each item should be no more than 100 characters long, in a list format. Only include the list in your response, no other text: ",
+    ),
+    PromptRoute(
+        '/hypothesis', 'hypothesis',
+        "Based on the finalProblemStatement, the Data Elements, the acceptanceCriteria and the targetCustomer, give me 5 potential solution hypotheses for this feature. Incorporate one of the Metrics in the format: 'X amount / percent of Target market / persona can do something / specific metric of the solution. No line breaks): ",
+    ),
+    PromptRoute(
+        '/marketing-material', 'marketingMaterial',
+        "Based on the target customer, market size, and solution hypotheses, provide me a list of potential marketing materials for this feature. Example 1: 'Blog: <title>', Example 2: 'Email: <Subject Line>, Example 3: 'Social Post: <Summary>. Each item should be no more than 200 characters long, in a list format. Only include the list in your response, no other text: ",
+    ),
+    PromptRoute(
+        '/feature-name', 'featureName',
+        "Based on the user story, target customer, and solution hypothesis, provide me a list of potential Feature Names for this feature. Each item should be no more than 4 words long, capitalised, in a list format. Only include the list in your response, no other text: ",
+        tier=TIER_FAST,
+    ),
+    PromptRoute(
+        '/whats-next', 'whatsNext',
+        "This is what i have so far in the product management process for my new feature, what should i do next? Provide this in list format, only provide the list items, no other commentary: ",
+        context_tokens=1500,
+    ),
+    PromptRoute(
+        '/feature-assess', 'FeatureAssess',
+        "This is what i have so far for my new feature. Please critically assess the feature, tell me the top 2 most important Strengths, 2 Weaknessess, 2 Threats and 2 Opportunities. 100 characters for each item maximum: ",
+        context_tokens=1500,
+    ),
+    PromptRoute(
+        '/task-list', 'TaskList',
+        "Given the following activity, generate me a 5 item task list of how I can get this activity done:",
+        tier=TIER_FAST,
+    ),
+    PromptRoute(
+        '/social-post', 'SocialPost',
+        "Based on the target customer, market size, and solution hypotheses, provide me with a social media post content I could use to communicate the feature. Make it 400 characters maximum. Only include the post content in your response, no other text:",
+        priority=PRIORITY_BULK,
+    ),
+    PromptRoute(
+        '/blog-post', 'BlogPost',
+        "Based on the target customer, market size, and solution hypotheses, provide me with a blog post I could use to communicate the feature. Make it 300 words maximum. Make this all return on 1 paragraph. Only include the post content in your response, no other text: ",
+        max_tokens=600,
+        timeout=60,
+        stream=True,
+        priority=PRIORITY_BULK,
+        latency_target=45,
+    ),
+    PromptRoute(
+        '/email-post', 'EmailPost',
+        "Based on the target customer, market size, and solution hypotheses, provide me with an email content I could use to communicate the feature. Make it 800 characters maximum. Make this all return in 1 single paragraph. Do not include the lines: 'Subject line, dear xyz, with regards, [your name] in the response, Only include the email content in your response, no other text: ",
+        priority=PRIORITY_BULK,
+    ),
+    PromptRoute(
+        '/frontend-code', 'FrontendCode',
+        "Based on the given user story, tasks, acceptance criteria, and solution, provide me with a piece of React code that is useable for the frontend of this feature. This should be formatted like React JSX code. Only return the code, no other text: ",
+        max_tokens=1000,
+        output=whole_text,
+        timeout=120,
+        stream=True,
+        context_tokens=2000,
+        priority=PRIORITY_BULK,
+        latency_target=90,
+    ),
+    PromptRoute(
+        '/backend-code', 'BackendCode',
+        "Based on the given user story, tasks, acceptance criteria, and solution, provide me with a piece of Python code that is useable for the frontend of this feature. This should be formatted like Python code. Only return the code, no other text: ",
+        max_tokens=1000,
+        output=whole_text,
+        timeout=120,
+        stream=True,
+        context_tokens=2000,
+        priority=PRIORITY_BULK,
+        latency_target=90,
+    ),
+]
+
+# Summarises blocks of accumulated input for context compaction. Not a public
+# route; its completions are cached like any other.
+SUMMARY_ROUTE = PromptRoute(
+    '/context-summary', 'contextSummary',
+    "Summarise the following product notes in at most 60 words. Keep every name, number and metric. Only include the summary, no other text: ",
+    max_tokens=120,
+    preprocess=keep_input,
+    output=whole_text,
+    priority=PRIORITY_SPECULATIVE,
+    tier=TIER_FAST,
+)
+
+ROUTES_BY_PATH = {route.path: route for route in PROMPT_ROUTES}
+STREAM_ROUTES_BY_PATH = {route.stream_path: route for route in PROMPT_ROUTES if route.stream}
+
+# The stage users nearly always go to next, guessed on each returned item
+# when speculative prefetch is on (see prefetch.py)
+PREFETCH_NEXT = {
+    '/openai-predict': ('/openai-solution',),
+    '/hypothesis': ('/feature-name', '/marketing-material'),
+}
+
+
+# Keyed on the raw input, not the prompt built from it: compaction sends a
+# different prompt once summaries are cached, which must not miss the cache.
+# Keyed on the route's primary model, so answers cached before a failover are still used
+def _cache_key(route, input_text):
+    return make_key(route.prompt_string, input_text, router.primary(route), route.max_tokens)
+
+# A fallback model's answers are kept under their own model's key, and only
+# briefly, so they never stand in for the primary's once it has recovered
+def _fallback_key(route, input_text, model):
+    return make_key(route.prompt_string, input_text, model, route.max_tokens)
+
+# A fallback model's answer to this input that is still cached, or None
+def _cached_fallback(route, input_text):
+    for model in router.models(route)[1:]:
+        # Capped at the fallback TTL however the entry reached this worker
+        predicted_text = response_cache.peek(_fallback_key(route, input_text, model), max_ttl=MODEL_FALLBACK_CACHE_TTL)
+        if predicted_text is not None:
+            return predicted_text
+    return None
+
+def _is_fallback(route, model):
+    return model != router.primary(route)
+
+def _cache_answer(route, input_text, key, model, predicted_text):
+    if _is_fallback(route, model):
+        response_cache.set(_fallback_key(route, input_text, model), predicted_text, ttl=MODEL_FALLBACK_CACHE_TTL)
+    else:
+        response_cache.set(key, predicted_text)
+
+# Cached answer another worker produced while this one waited for the lock.
+# Returns the text and whether a fallback model wrote it, or None.
+def _recheck(route, input_text, key):
+    predicted_text = response_cache.peek(key)
+    if predicted_text is not None:
+        return predicted_text, False
+    predicted_text = _cached_fallback(route, input_text)
+    if predicted_text is not None:
+        return predicted_text, True
+    return None
+
+# The input as it goes into the prompt: compacted to the route's budget, then preprocessed
+def _prompt_input(route, input_text):
+    if route.context_tokens:
+        input_text = _compact_input(route, input_text)
+    return route.preprocess(input_text)
+
+# Look up the cache for a route before going upstream. Returns the input as
+# it goes into the prompt (only built on a miss), the cache key, any cached
+# text and the cache status.
+def _lookup(route, input_text, bypass_cache, speculative=False):
+    key = _cache_key(route, input_text)
+
+    # A real request for this key means its sibling guesses won't be needed,
+    # and a guess for it still waiting for quota now waits at this route's priority
+    if not speculative:
+        prefetcher.claim(key)
+        scheduler.promote(key, route.priority)
+
+    # Clients can force a fresh completion with the bypass header
+    if bypass_cache:
+        response_cache.record_bypass()
+        return _build_prompt(route, input_text), key, None, 'BYPASS'
+
+    predicted_text = response_cache.get(key)
+    if predicted_text is None and NEAR_DUP_SERVE and near_duplicates.covers(route):
+        _, predicted_text = _near_duplicate(route, input_text, key)
+        if predicted_text is not None:
+            return None, key, predicted_text, 'NEAR_HIT'
+    # Remember the input (hit or not) so later edits of it can be matched
+    if near_duplicates.covers(route):
+        near_duplicates.add(route, input_text, key)
+    if predicted_text is not None:
+        return None, key, predicted_text, 'HIT'
+    # While failed over, the fallback's recent answers are better than another call
+    if _is_fallback(route, router.current(route)):
+        predicted_text = _cached_fallback(route, input_text)
+        if predicted_text is not None:
+            return None, key, predicted_text, 'FALLBACK'
+    return _build_prompt(route, input_text), key, None, 'MISS'
+
+def _build_prompt(route, input_text):
+    with metrics.timed('prompt_build_seconds', route.path):
+        return _prompt_input(route, input_text)
+
+# Most similar earlier input to the route whose completion is still cached.
+# Returns its similarity and completion, or (None, None).
+def _near_duplicate(route, input_text, key):
+    for similarity, match_key in near_duplicates.query(route, input_text, exclude=key):
+        predicted_text = response_cache.peek(match_key)
+        if predicted_text is not None:
+            return similarity, predicted_text
+    return None, None
+
+# The completion of an earlier near-duplicate of this input, for the client
+# to offer instead of generating. Returns the similarity and payload, or None.
+def similar(route, input_text):
+    if not near_duplicates.covers(route):
+        return None
+    key = _cache_key(route, input_text)
+    predicted_text = response_cache.peek(key)
+    similarity = 1.0
+    if predicted_text is None:
+        similarity, predicted_text = _near_duplicate(route, input_text, key)
+    if predicted_text is None:
+        return None
+    return similarity, _payload(route, predicted_text)
+
+# Fit the accumulated input into the route's token budget, using cached block
+# summaries where there are some and queueing summaries for the rest
+def _compact_input(route, input_text):
+    input_text, to_summarise = compact(input_text, route.context_tokens, _cached_summary)
+    if to_summarise:
+        summariser.schedule([
+            PrefetchJob(SUMMARY_ROUTE, block, _cache_key(SUMMARY_ROUTE, block), SUMMARY_ROUTE.estimate_cost(block))
+            for block in to_summarise
+        ])
+    metrics.observe('context_tokens', route.path, count_tokens(input_text))
+    return input_text
+
+def _cached_summary(block):
+    return response_cache.peek(_cache_key(SUMMARY_ROUTE, block))
+
+# Extract the completion text from the API response and cache it
+def _read_response(route, input_text, key, model, response):
+    # Check for errors in the response
+    if 'choices' in response and len(response['choices']) > 0:
+        predicted_text = response['choices'][0]['message']['content'].strip()
+        _cache_answer(route, input_text, key, model, predicted_text)
+        return predicted_text
+    else:
+        print("No 'choices' in API response")
+        print(response)
+        return None
+
+# Tokens the API says the completion used, if it reported usage
+def _total_tokens(response):
+    usage = response.get('usage') or {}
+    return usage.get('total_tokens')
+
+# Collect the streamed completion, settle its quota ticket and, if the stream
+# finished, cache it. Streams report no usage, so it is counted from the text.
+def _finish_stream(route, input_text, key, model, ticket, prompt_input, parts, complete=True):
+    predicted_text = ''.join(parts).strip()
+    scheduler.settle(ticket, count_tokens(route.build_prompt(prompt_input)) + count_tokens(predicted_text))
+    if not complete:
+        return None
+    if not predicted_text:
+        print("No content in streamed API response")
+        return None
+    _cache_answer(route, input_text, key, model, predicted_text)
+    return predicted_text
+
+# Pull the new text out of a streamed completion chunk
+def _chunk_text(chunk):
+    if 'choices' in chunk and len(chunk['choices']) > 0:
+        return chunk['choices'][0].get('delta', {}).get('content')
+    return None
+
+# Format one Server-Sent Event
+def sse_event(event, data):
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+
+# Build the JSON payload for a route from the completion text
+def _payload(route, predicted_text):
+    if predicted_text is None:
+        return dict(NO_CHOICES_ERROR)
+    return {'predicted_items': route.output(predicted_text)}
+
+
+# Get the completion text for a route, reusing a cached completion when possible.
+# Returns the predicted text (or None) and the cache status for the response header,
+# which is FALLBACK whenever the answer came from a fallback model.
+# Speculative calls come from the prefetcher and run at the lowest priority.
+def complete(route, input_text, bypass_cache=False, speculative=False):
+    prompt_input, key, predicted_text, cache_status = _lookup(route, input_text, bypass_cache, speculative)
+    if predicted_text is not None:
+        return predicted_text, cache_status
+    priority = PRIORITY_SPECULATIVE if speculative else route.priority
+
+    def fetch():
+        # Wait for room in the OpenAI quota (or get shed with a 429)
+        ticket = scheduler.acquire(route.estimate_cost(prompt_input), priority, key if speculative else None)
+        model = router.choose(route)
+        with metrics.timed('upstream_seconds', route.path), router.timed(route, model):
+            response = upstream.create(
+                route.timeout,
+                model=model,
+                messages=route.messages(prompt_input),
+                max_tokens=route.max_tokens
+            )
+        metrics.record_usage(route.path, response)
+        scheduler.settle(ticket, _total_tokens(response))
+        return _read_response(route, input_text, key, model, response), _is_fallback(route, model)
+
+    # Identical requests already in flight share one upstream call. Another
+    # worker's result is only reused when the client didn't ask for a fresh one.
+    recheck = None if bypass_cache else lambda: _recheck(route, input_text, key)
+    (predicted_text, fallback), shared = single_flight.do(key, fetch, recheck)
+    if fallback:
+        return predicted_text, 'FALLBACK'
+    return predicted_text, 'COALESCED' if shared else cache_status
+
+# Call fn with the response cache from the default thread pool when its
+# on-disk tier is on, so file reads and writes never block the event loop.
+# The request's context goes along for the metrics record.
+async def _cache_call(fn, *args):
+    if not response_cache.cache_dir:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, contextvars.copy_context().run, fn, *args)
+
+# Same as complete() but awaits the async client so the event loop is never blocked
+async def complete_async(route, input_text, bypass_cache=False):
+    prompt_input, key, predicted_text, cache_status = await _cache_call(_lookup, route, input_text, bypass_cache)
+    if predicted_text is not None:
+        return predicted_text, cache_status
+
+    async def fetch():
+        ticket = await scheduler.acquire_async(route.estimate_cost(prompt_input), route.priority)
+        model = router.choose(route)
+        with metrics.timed('upstream_seconds', route.path), router.timed(route, model):
+            response = await upstream.acreate(
+                route.timeout,
+                model=model,
+                messages=route.messages(prompt_input),
+                max_tokens=route.max_tokens
+            )
+        metrics.record_usage(route.path, response)
+        scheduler.settle(ticket, _total_tokens(response))
+        predicted_text = await _cache_call(_read_response, route, input_text, key, model, response)
+        return predicted_text, _is_fallback(route, model)
+
+    recheck = None if bypass_cache else lambda: _recheck(route, input_text, key)
+    (predicted_text, fallback), shared = await single_flight.do_async(key, fetch, recheck)
+    if fallback:
+        return predicted_text, 'FALLBACK'
+    return predicted_text, 'COALESCED' if shared else cache_status
+
+
+# Earlier inputs per route, so paraphrased resubmissions reuse their completions
+near_duplicates = NearDuplicateIndex()
+
+# Guesses run in background threads with the sync client in both modes
+prefetcher = Prefetcher(
+    lambda route, input_text: complete(route, input_text, speculative=True),
+    response_cache.peek,
+)
+# Context summaries run the same way, with their own switch and budget
+summariser = Prefetcher(
+    lambda route, input_text: complete(route, input_text, speculative=True),
+    response_cache.peek,
+    enabled=CONTEXT_SUMMARIES_ENABLED,
+    workers=1,
+    tpm=CONTEXT_SUMMARY_TPM,
+)
+
+# Queue guesses for the likely next stage on each item a stage returned
+def _prefetch_next(route, predicted_text):
+    if not prefetcher.enabled or predicted_text is None or route.path not in PREFETCH_NEXT:
+        return
+    items = [item.strip() for item in split_lines(predicted_text) if item.strip()][:PREFETCH_MAX_ITEMS]
+    jobs = []
+    for path in PREFETCH_NEXT[route.path]:
+        next_route = ROUTES_BY_PATH[path]
+        for item in items:
+            next_input = next_route.preprocess(item)
+            jobs.append(PrefetchJob(next_route, item, _cache_key(next_route, item), next_route.estimate_cost(next_input)))
+    prefetcher.schedule(jobs)
+
+
+# Run a route end to end and build its JSON payload. Funnel pipelines pass
+# prefetch=False since they already say which stage comes next.
+def run_route(route, input_text, bypass_cache=False, prefetch=True):
+    predicted_text, cache_status = complete(route, input_text, bypass_cache)
+    metrics.count_cache(route.path, cache_status)
+    if prefetch:
+        _prefetch_next(route, predicted_text)
+    return _payload(route, predicted_text), cache_status
+
+async def run_route_async(route, input_text, bypass_cache=False, prefetch=True):
+    predicted_text, cache_status = await complete_async(route, input_text, bypass_cache)
+    metrics.count_cache(route.path, cache_status)
+    if prefetch:
+        _prefetch_next(route, predicted_text)
+    return _payload(route, predicted_text), cache_status
+
+
+# Stream a route's completion as Server-Sent Events.
+# Each 'token' event carries the next piece of text and the final 'done' event
+# carries the same payload the non-streaming route returns; a stream that
+# fails part way ends with an 'error' event instead.
+# Returns the event generator and the cache status for the response header.
+def stream_route(route, input_text, bypass_cache=False):
+    prompt_input, key, predicted_text, cache_status = _lookup(route, input_text, bypass_cache)
+
+    # Open the stream before the response starts so upstream errors get a proper status
+    chunks = None
+    model = None
+    ticket = None
+    if predicted_text is None:
+        ticket = scheduler.acquire(route.estimate_cost(prompt_input), route.priority)
+        model = router.choose(route)
+        if _is_fallback(route, model):
+            cache_status = 'FALLBACK'
+        # Streams record the time until the API starts answering
+        with metrics.timed('upstream_seconds', route.path), router.timed(route, model):
+            chunks = upstream.create(
+                route.timeout,
+                model=model,
+                messages=route.messages(prompt_input),
+                max_tokens=route.max_tokens,
+                stream=True
+            )
+    metrics.count_cache(route.path, cache_status)
+    finish = lambda parts, complete=True: _finish_stream(route, input_text, key, model, ticket, prompt_input, parts, complete)
+    return _stream_events(route, chunks, predicted_text, finish), cache_status
+
+# The response has already started, so a stream that fails part way ends
+# with an 'error' event instead of 'done'
+def _stream_events(route, chunks, predicted_text, finish):
+    if chunks is not None:
+        parts = []
+        try:
+            for chunk in chunks:
+                token = _chunk_text(chunk)
+                if token:
+                    parts.append(token)
+                    yield sse_event('token', {'token': token})
+        except (UpstreamError, openai.error.OpenAIError) as e:
+            finish(parts, complete=False)
+            yield _stream_error(e)
+            return
+        predicted_text = finish(parts)
+
+    yield sse_event('done', _payload(route, predicted_text))
+
+def _stream_error(error):
+    return sse_event('error', {'error': str(error), 'status': getattr(error, 'status', 502)})
+
+async def stream_route_async(route, input_text, bypass_cache=False):
+    prompt_input, key, predicted_text, cache_status = await _cache_call(_lookup, route, input_text, bypass_cache)
+
+    chunks = None
+    model = None
+    ticket = None
+    if predicted_text is None:
+        ticket = await scheduler.acquire_async(route.estimate_cost(prompt_input), route.priority)
+        model = router.choose(route)
+        if _is_fallback(route, model):
+            cache_status = 'FALLBACK'
+        # Streams record the time until the API starts answering
+        with metrics.timed('upstream_seconds', route.path), router.timed(route, model):
+            chunks = await upstream.acreate(
+                route.timeout,
+                model=model,
+                messages=route.messages(prompt_input),
+                max_tokens=route.max_tokens,
+                stream=True
+            )
+    metrics.count_cache(route.path, cache_status)
+    finish = lambda parts, complete=True: _finish_stream(route, input_text, key, model, ticket, prompt_input, parts, complete)
+    return _stream_events_async(route, chunks, predicted_text, finish), cache_status
+
+async def _stream_events_async(route, chunks, predicted_text, finish):
+    if chunks is not None:
+        parts = []
+        try:
+            async for chunk in chunks:
+                token = _chunk_text(chunk)
+                if token:
+                    parts.append(token)
+                    yield sse_event('token', {'token': token})
+        except (UpstreamError, openai.error.OpenAIError) as e:
+            finish(parts, complete=False)
+            yield _stream_error(e)
+            return
+        predicted_text = await _cache_call(finish, parts)
+
+    yield sse_event('done', _payload(route, predicted_text))
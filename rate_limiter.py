@@ -0,0 +1,228 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from upstream_client import UpstreamError
+
+# Load the .env file
+load_dotenv()
+
+# OpenAI quota for this worker. Divide the account's limits by the number of
+# gunicorn workers. Leaving both unset turns the scheduler off.
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))
+# Requests allowed to wait for budget, and the longest wait before shedding with a 429
+RATE_LIMIT_QUEUE_SIZE = int(os.getenv("RATE_LIMIT_QUEUE_SIZE", "64"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))
+
+# Route priorities, lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+# Speculative prefetches only use budget nothing else is waiting for
+PRIORITY_SPECULATIVE = 3
+
+
+# Raised when a request is shed because the quota can't admit it soon enough
+class RateLimitedError(UpstreamError):
+    def __init__(self, retry_after):
+        super().__init__("Too many requests to the OpenAI API, try again shortly", 429, retry_after)
+
+
+# Rough token count for a prompt (about 4 characters per token for English)
+def estimate_prompt_tokens(prompt):
+    return len(prompt) // 4 + 1
+
+# Worst-case tokens a completion can use: the prompt plus every completion token
+def estimate_cost(prompt, max_tokens):
+    return estimate_prompt_tokens(prompt) + max_tokens
+
+
+# Refills continuously at capacity per minute
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until amount is available (0 if it is available now)
+    def wait_time(self, amount):
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0.0) / self.rate
+
+
+# Admits upstream calls against the TPM/RPM buckets in priority order
+class Scheduler:
+    def __init__(self, tpm=OPENAI_TPM, rpm=OPENAI_RPM, queue_size=RATE_LIMIT_QUEUE_SIZE, max_wait=RATE_LIMIT_MAX_WAIT):
+        self.buckets = {}
+        if tpm:
+            self.buckets['tokens'] = TokenBucket(tpm)
+        if rpm:
+            self.buckets['requests'] = TokenBucket(rpm)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._queue = []
+        # Queued entries acquired with a key, so a later request can promote them
+        self._keyed = {}
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self.counters = {'admitted': 0, 'shed': 0, 'waited': 0, 'promoted': 0}
+
+    @property
+    def enabled(self):
+        return bool(self.buckets)
+
+    # Block until the call is admitted. Returns the ticket to settle with once
+    # the real token usage is known. Giving a key lets promote() raise the
+    # call's priority while it waits.
+    def acquire(self, cost, priority=PRIORITY_NORMAL, key=None):
+        if not self.enabled:
+            return None
+        with self._cond:
+            entry = self._enqueue(cost, priority, key)
+            while True:
+                delay = self._try_admit(entry)
+                if delay == 0:
+                    self._cond.notify_all()
+                    return entry
+                self._cond.wait(self._wait_or_shed(entry, delay))
+
+    async def acquire_async(self, cost, priority=PRIORITY_NORMAL, key=None):
+        if not self.enabled:
+            return None
+        with self._cond:
+            entry = self._enqueue(cost, priority, key)
+        try:
+            while True:
+                with self._cond:
+                    delay = self._try_admit(entry)
+                    if delay == 0:
+                        self._cond.notify_all()
+                        return entry
+                    delay = self._wait_or_shed(entry, delay)
+                # Poll so a request ahead of us finishing is noticed quickly
+                await asyncio.sleep(min(delay, 0.05))
+        except asyncio.CancelledError:
+            with self._cond:
+                self._remove(entry)
+            raise
+
+    # A request with a higher priority now waits on the queued call acquired
+    # with key (e.g. a real request joining a speculative prefetch): move the
+    # call up to that priority and give it a full max_wait from now
+    def promote(self, key, priority):
+        if not self.enabled:
+            return
+        with self._cond:
+            entry = self._keyed.get(key)
+            if entry is None or entry[0] <= priority:
+                return
+            entry[0] = priority
+            entry[3] = max(entry[3], time.monotonic() + self.max_wait)
+            heapq.heapify(self._queue)
+            self.counters['promoted'] += 1
+            self._cond.notify_all()
+
+    # Correct the token bucket once the API reports the real usage
+    def settle(self, entry, total_tokens):
+        if entry is None or total_tokens is None or 'tokens' not in self.buckets:
+            return
+        with self._cond:
+            bucket = self.buckets['tokens']
+            bucket.refill(time.monotonic())
+            bucket.level = min(bucket.capacity, bucket.level + entry[2] - total_tokens)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            stats = dict(self.counters)
+            stats['queued'] = len(self._queue)
+            for name, bucket in self.buckets.items():
+                bucket.refill(now)
+                stats[name + '_available'] = int(bucket.level)
+                stats[name + '_per_minute'] = int(bucket.capacity)
+        stats['enabled'] = self.enabled
+        return stats
+
+    # Queue the request, or shed it straight away with a 429 if the queue is
+    # full or the budget can't admit it within max_wait
+    def _enqueue(self, cost, priority, key=None):
+        now = time.monotonic()
+        for bucket in self.buckets.values():
+            bucket.refill(now)
+
+        ahead = [queued for queued in self._queue if queued[0] <= priority]
+        tokens_ahead = sum(queued[2] for queued in ahead)
+        wait = 0.0
+        if 'tokens' in self.buckets:
+            wait = max(wait, self.buckets['tokens'].wait_time(tokens_ahead + cost))
+        if 'requests' in self.buckets:
+            wait = max(wait, self.buckets['requests'].wait_time(len(ahead) + 1))
+
+        if len(self._queue) >= self.queue_size or wait > self.max_wait:
+            self.counters['shed'] += 1
+            raise RateLimitedError(max(wait, 1.0))
+
+        # Priority, arrival order, cost, the time by which it must be admitted and its key
+        entry = [priority, next(self._sequence), cost, now + self.max_wait, key]
+        heapq.heappush(self._queue, entry)
+        if key is not None:
+            self._keyed[key] = entry
+        if wait > 0:
+            self.counters['waited'] += 1
+        return entry
+
+    # Admit the entry if it is at the head of the queue and the buckets have room.
+    # Returns 0 when admitted, otherwise how long to wait before trying again.
+    def _try_admit(self, entry):
+        now = time.monotonic()
+        for bucket in self.buckets.values():
+            bucket.refill(now)
+        if self._queue[0] is not entry:
+            return 0.05
+
+        amounts = {'tokens': entry[2], 'requests': 1}
+        delay = max(bucket.wait_time(amounts[name]) for name, bucket in self.buckets.items())
+        if delay > 0:
+            return delay
+
+        for name, bucket in self.buckets.items():
+            bucket.level -= min(amounts[name], bucket.capacity)
+        heapq.heappop(self._queue)
+        self._forget(entry)
+        self.counters['admitted'] += 1
+        return 0
+
+    # How long to wait before trying to admit the entry again. Once its
+    # deadline has passed (higher-priority traffic kept getting ahead of it),
+    # it leaves the queue and is shed with a 429.
+    def _wait_or_shed(self, entry, delay):
+        remaining = entry[3] - time.monotonic()
+        if remaining <= 0:
+            self._remove(entry)
+            self.counters['shed'] += 1
+            raise RateLimitedError(max(delay, 1.0))
+        return min(delay, remaining)
+
+    def _remove(self, entry):
+        self._queue.remove(entry)
+        heapq.heapify(self._queue)
+        self._forget(entry)
+        self._cond.notify_all()
+
+    def _forget(self, entry):
+        if entry[4] is not None and self._keyed.get(entry[4]) is entry:
+            del self._keyed[entry[4]]
+
+
+# Shared scheduler for this worker
+scheduler = Scheduler()
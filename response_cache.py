@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Load the .env file
+load_dotenv()
+
+# Cache settings (can be overridden in the .env file)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "512"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "86400"))
+# Setting CACHE_DIR turns on the on-disk tier shared by all gunicorn workers
+CACHE_DIR = os.getenv("CACHE_DIR")
+# Size the on-disk tier is kept under; entries expiring soonest go first
+CACHE_DISK_MAX_MB = float(os.getenv("CACHE_DISK_MAX_MB", "512"))
+# How often each worker sweeps expired entries out of the on-disk tier
+CACHE_SWEEP_SECONDS = float(os.getenv("CACHE_SWEEP_SECONDS", "300"))
+
+# Request header that skips the cache lookup for a single request
+BYPASS_HEADER = "X-Cache-Bypass"
+
+
+def normalize_input(input_text):
+    # Collapse whitespace so trivially different submissions share a key
+    return ' '.join(input_text.split())
+
+
+def make_key(prompt_string, input_text, model, max_tokens):
+    # Content-addressed key over everything that changes the completion
+    payload = json.dumps([prompt_string, normalize_input(input_text), model, max_tokens])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def is_bypass(headers):
+    value = headers.get(BYPASS_HEADER, '')
+    return value.strip().lower() in ('1', 'true', 'yes')
+
+
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, cache_dir=CACHE_DIR,
+                 disk_max_bytes=CACHE_DISK_MAX_MB * 1024 * 1024, sweep_interval=CACHE_SWEEP_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._last_sweep = time.time()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypasses': 0, 'evictions': 0,
+                         'disk_sweeps': 0, 'disk_evictions': 0}
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key):
+        now = time.time()
+
+        # In-process LRU tier
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return value
+                del self._entries[key]
+
+        # Shared on-disk tier
+        expires, value = self._disk_get(key, now)
+        with self._lock:
+            if value is not None:
+                self.counters['disk_hits'] += 1
+            else:
+                self.counters['misses'] += 1
+        if value is not None:
+            # Promoted for the entry's remaining time, not a fresh TTL
+            self._memory_set(key, value, now, expires - now)
+        return value
+
+    # Look up an entry without touching the hit/miss counters. With max_ttl,
+    # an entry with longer than that left is only kept in memory for max_ttl.
+    def peek(self, key, max_ttl=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                if max_ttl is not None and entry[0] > now + max_ttl:
+                    self._entries[key] = (now + max_ttl, entry[1])
+                return entry[1]
+        expires, value = self._disk_get(key, now)
+        if value is not None:
+            ttl = expires - now
+            self._memory_set(key, value, now, ttl if max_ttl is None else min(ttl, max_ttl))
+        return value
+
+    # ttl overrides the cache's TTL for this entry
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        self._memory_set(key, value, now, ttl)
+        self._disk_set(key, value, now, ttl)
+
+    def record_bypass(self):
+        with self._lock:
+            self.counters['bypasses'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._entries)
+        stats['max_entries'] = self.max_entries
+        stats['ttl_seconds'] = self.ttl
+        stats['disk_enabled'] = bool(self.cache_dir)
+        stats['disk_max_bytes'] = self.disk_max_bytes
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _memory_set(self, key, value, now, ttl=None):
+        with self._lock:
+            self._entries[key] = (now + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            # Evict the least recently used entries once we are over capacity
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    # Returns the entry's expiry time and value, or (None, None)
+    def _disk_get(self, key, now):
+        if not self.cache_dir:
+            return None, None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        expires = entry.get('expires', 0)
+        if expires <= now:
+            # Expired entries are removed lazily by whichever worker finds them
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None, None
+        return expires, entry.get('value')
+
+    def _disk_set(self, key, value, now, ttl):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file and rename so other workers never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'expires': now + ttl, 'value': value}, f)
+            # The file's mtime is its expiry, so sweeps only need to stat it
+            os.utime(tmp_path, (now, now + ttl))
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        if now - self._last_sweep >= self.sweep_interval:
+            self._start_sweep(now)
+
+    # Sweep in the background so the request that noticed it is due doesn't wait
+    def _start_sweep(self, now):
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        self._last_sweep = now
+        threading.Thread(target=self._sweep, name='cache-sweep', daemon=True).start()
+
+    # Remove expired entries (and temp files left by killed workers), then the
+    # entries expiring soonest until the tier fits in disk_max_bytes. Every
+    # worker sweeps on its own schedule; removing a file twice is harmless.
+    def _sweep(self):
+        try:
+            now = time.time()
+            entries = []
+            total = 0
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if entry.name.endswith('.tmp'):
+                        # Anything still being written is only a moment old
+                        if stat.st_mtime < now - 3600:
+                            self._remove(entry.path)
+                    elif stat.st_mtime <= now:
+                        self._remove(entry.path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+
+            evicted = 0
+            if total > self.disk_max_bytes:
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= self.disk_max_bytes:
+                        break
+                    self._remove(path)
+                    total -= size
+                    evicted += 1
+            with self._lock:
+                self.counters['disk_sweeps'] += 1
+                self.counters['disk_evictions'] += evicted
+        except OSError as e:
+            print("Cache sweep failed: %s" % e, flush=True)
+        finally:
+            self._sweep_lock.release()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# Shared cache instance for this worker
+response_cache = ResponseCache()
@@ -0,0 +1,267 @@
+import gzip
+import io
+import os
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from micro_batcher import MicroBatcher
+import model_registry
+
+# Load the .env file
+load_dotenv()
+
+# Models written by train_linear_regression.py. The current version in the
+# model registry (see model_registry.py) is served when there is one. The
+# artefact holds just the coefficients and loads with numpy alone; the pickle
+# needs sklearn and is only used when there is neither.
+MODEL_ARTEFACT_PATH = os.getenv("MODEL_ARTEFACT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'salary_model.npz'))
+MODEL_PATH = os.getenv("MODEL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trained_model.pkl'))
+# Largest batch one request may score
+MAX_BATCH_ROWS = int(os.getenv("MAX_BATCH_ROWS", "100000"))
+# Rows parsed and scored at a time by the CSV bulk-scoring route
+PREDICT_CSV_CHUNK_ROWS = int(os.getenv("PREDICT_CSV_CHUNK_ROWS", "10000"))
+# Score small concurrent requests together (see micro_batcher.py)
+MICRO_BATCH_ENABLED = os.getenv("MICRO_BATCH_ENABLED", "1").strip().lower() in ('1', 'true', 'yes')
+
+# Input features in the order the model was trained on (Age, Weight)
+FEATURES = ('age', 'weight')
+# Bump when the artefact layout changes
+ARTEFACT_SCHEMA_VERSION = 1
+
+_model = None
+_model_lock = threading.Lock()
+# Registry version that failed to load, so it isn't retried on every request
+_failed_version = None
+
+
+# Raised for a request body that can't be scored (the route answers 400)
+class InvalidRecordsError(ValueError):
+    pass
+
+
+# Raised for a model artefact that is missing fields or from another schema version
+class InvalidArtefactError(ValueError):
+    pass
+
+
+# Linear regression scored with plain numpy: features @ coef + intercept
+class LinearModel:
+    def __init__(self, coef, intercept, features=FEATURES, version=None, metadata=None):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.features = tuple(features)
+        # Registry version and metadata, when loaded from the registry
+        self.version = version
+        self.metadata = metadata or {}
+
+    def predict(self, features):
+        return features @ self.coef + self.intercept
+
+
+# Write the model as an .npz artefact. The file is written next to the target
+# and renamed into place, so workers never load a half-written artefact.
+def save_artefact(model, path=MODEL_ARTEFACT_PATH):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(
+            f,
+            schema_version=np.array(ARTEFACT_SCHEMA_VERSION),
+            coef=model.coef,
+            intercept=np.array(model.intercept),
+            features=np.array(model.features),
+        )
+    os.replace(tmp_path, path)
+
+
+def load_artefact(path=MODEL_ARTEFACT_PATH):
+    with np.load(path, allow_pickle=False) as artefact:
+        try:
+            version = int(artefact['schema_version'])
+            if version != ARTEFACT_SCHEMA_VERSION:
+                raise InvalidArtefactError("%s has schema version %d, expected %d" % (path, version, ARTEFACT_SCHEMA_VERSION))
+            model = LinearModel(artefact['coef'], artefact['intercept'], artefact['features'].tolist())
+        except KeyError as e:
+            raise InvalidArtefactError("%s is missing %s" % (path, e)) from e
+    if model.coef.shape != (len(model.features),):
+        raise InvalidArtefactError("%s has %d coefficients for %d features" % (path, model.coef.size, len(model.features)))
+    return model
+
+
+# Convert a fitted sklearn LinearRegression into a LinearModel. Estimators
+# fitted on plain arrays have no feature names and are assumed to use FEATURES.
+def from_sklearn(estimator):
+    names = getattr(estimator, 'feature_names_in_', FEATURES)
+    return LinearModel(estimator.coef_, estimator.intercept_, [name.lower() for name in names])
+
+
+# Store a trained model as the next registry version and make it current.
+# Running workers switch to it on their next request.
+def publish_model(model, **metadata):
+    metadata = dict(metadata, features=list(model.features), schema_version=ARTEFACT_SCHEMA_VERSION)
+    return model_registry.publish(np.concatenate([[model.intercept], model.coef]), metadata)
+
+
+def load_version(version):
+    weights, metadata = model_registry.load(version)
+    if not isinstance(metadata, dict):
+        raise InvalidArtefactError("Model version %s has metadata that isn't an object" % version)
+    if metadata.get('schema_version') != ARTEFACT_SCHEMA_VERSION:
+        raise InvalidArtefactError("Model version %s has schema version %s, expected %d" % (version, metadata.get('schema_version'), ARTEFACT_SCHEMA_VERSION))
+    features = metadata.get('features')
+    if not isinstance(features, list) or not all(isinstance(name, str) for name in features):
+        raise InvalidArtefactError("Model version %s is missing its feature list" % version)
+    if weights.shape != (len(features) + 1,):
+        raise InvalidArtefactError("Model version %s has %d weights for %d features" % (version, weights.size, len(features)))
+    # Slices of the memory-mapped weights, so the pages stay shared
+    return LinearModel(weights[1:], weights[0], features, version, metadata)
+
+
+# The model to score with. Checks the registry's current version on every
+# call and loads a new one when it has changed; requests already scoring keep
+# the model object they started with. Without a registry the artefact (or
+# the pickle) is loaded once per worker.
+def get_model():
+    global _model, _failed_version
+    version = model_registry.current_version()
+    model = _model
+    if model is not None and (version is None or version == model.version or version == _failed_version):
+        return model
+
+    with _model_lock:
+        if _model is not None and (version is None or version == _model.version or version == _failed_version):
+            return _model
+        if version is not None:
+            try:
+                _model = load_version(version)
+                return _model
+            except (model_registry.UnknownVersionError, InvalidArtefactError, ValueError, OSError) as e:
+                _failed_version = version
+                print("Could not load model version %s: %s" % (version, e), flush=True)
+                if _model is not None:
+                    return _model
+        if os.path.exists(MODEL_ARTEFACT_PATH):
+            _model = load_artefact(MODEL_ARTEFACT_PATH)
+        else:
+            import joblib
+            _model = from_sklearn(joblib.load(MODEL_PATH))
+    return _model
+
+
+# Version and metadata of the model being served
+def model_info():
+    model = get_model()
+    return {
+        'version': model.version,
+        'features': list(model.features),
+        'coef': model.coef.tolist(),
+        'intercept': model.intercept,
+        'metadata': model.metadata,
+    }
+
+
+# Groups concurrent small requests into one predict call
+batcher = MicroBatcher(lambda features: get_model().predict(features))
+
+
+# Turn the request body into an (n, 2) float array.
+# Accepts a single record {"age": 30, "weight": 70}, a list of records
+# [{"age": ..., "weight": ...}, ...] or columns {"age": [...], "weight": [...]}.
+# Returns the array and whether the body was a single record.
+def parse_records(body):
+    try:
+        if isinstance(body, list):
+            if len(body) > MAX_BATCH_ROWS:
+                raise InvalidRecordsError("At most %d records per request" % MAX_BATCH_ROWS)
+            ages = [record['age'] for record in body]
+            weights = [record['weight'] for record in body]
+            single = False
+        elif isinstance(body, dict):
+            ages, weights = body['age'], body['weight']
+            single = not isinstance(ages, list)
+            if single:
+                ages, weights = [ages], [weights]
+            elif len(ages) != len(weights):
+                raise InvalidRecordsError("'age' and 'weight' must have the same length")
+            elif len(ages) > MAX_BATCH_ROWS:
+                raise InvalidRecordsError("At most %d records per request" % MAX_BATCH_ROWS)
+        else:
+            raise InvalidRecordsError("Request body must be a record, a list of records or columns")
+
+        features = np.empty((len(ages), 2), dtype=np.float64)
+        features[:, 0] = ages
+        features[:, 1] = weights
+    except (KeyError, TypeError) as e:
+        raise InvalidRecordsError("Every record needs numeric 'age' and 'weight' values") from e
+    except ValueError as e:
+        if isinstance(e, InvalidRecordsError):
+            raise
+        raise InvalidRecordsError("Every record needs numeric 'age' and 'weight' values") from e
+
+    if not np.isfinite(features).all():
+        raise InvalidRecordsError("'age' and 'weight' must be finite numbers")
+    return features, single
+
+
+# Score every row in one vectorized predict call (shared with other requests
+# when micro-batching is on). Salaries below zero are set to zero and
+# everything is returned as whole numbers.
+def predict_salaries(features):
+    if len(features) == 0:
+        return np.empty(0, dtype=np.int64)
+    if MICRO_BATCH_ENABLED:
+        predicted = batcher.predict(features)
+    else:
+        predicted = get_model().predict(features)
+    return np.maximum(predicted, 0).astype(np.int64)
+
+
+# Open an uploaded CSV (gzip'd or not) for line-by-line reading. Returns the
+# header, the positions of the age and weight columns and the remaining
+# lines. Only the header is read here; the rest is read as it is scored.
+def open_csv(stream, gzipped=False):
+    if gzipped:
+        stream = gzip.GzipFile(fileobj=stream)
+    lines = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    try:
+        header = next(lines, '').rstrip('\r\n')
+    except (OSError, EOFError, ValueError) as e:
+        raise InvalidRecordsError("Could not read the CSV: %s" % e) from e
+    names = [name.strip().lower() for name in header.split(',')]
+    missing = [name for name in FEATURES if name not in names]
+    if missing:
+        raise InvalidRecordsError("CSV header needs %s columns" % ' and '.join(repr(name.capitalize()) for name in missing))
+    return header, [names.index(name) for name in FEATURES], lines
+
+
+# Score CSV lines in chunks of chunk_rows, yielding the output CSV a chunk at
+# a time: every input line with its predicted salary appended. Memory stays at
+# one chunk whatever the file size. Headers have already gone out by the time
+# a bad row is found, so it ends the output with an "# error:" line instead.
+def score_csv(header, columns, lines, chunk_rows=PREDICT_CSV_CHUNK_ROWS):
+    yield header + ',PredictedSalary\n'
+    line_number = 1
+    chunk = []
+    try:
+        for line in lines:
+            line_number += 1
+            line = line.rstrip('\r\n')
+            if line:
+                chunk.append(line)
+            if len(chunk) >= chunk_rows:
+                yield _score_csv_chunk(chunk, columns, line_number)
+                chunk = []
+        if chunk:
+            yield _score_csv_chunk(chunk, columns, line_number)
+    except (InvalidRecordsError, OSError, EOFError, ValueError) as e:
+        yield '# error: %s\n' % e
+
+
+def _score_csv_chunk(chunk, columns, last_line_number):
+    try:
+        features = np.loadtxt(chunk, delimiter=',', usecols=columns, ndmin=2, dtype=np.float64)
+    except ValueError as e:
+        raise InvalidRecordsError("Bad row in lines %d-%d: %s" % (last_line_number - len(chunk) + 1, last_line_number, e)) from e
+    if not np.isfinite(features).all():
+        raise InvalidRecordsError("Non-finite age or weight in lines %d-%d" % (last_line_number - len(chunk) + 1, last_line_number))
+    predicted = predict_salaries(features)
+    return ''.join('%s,%d\n' % (line, salary) for line, salary in zip(chunk, predicted.tolist()))
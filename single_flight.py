@@ -0,0 +1,198 @@
+import asyncio
+import os
+import threading
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on this platform, so only in-process coalescing is available
+    fcntl = None
+
+# Load the .env file
+load_dotenv()
+
+# Setting SINGLE_FLIGHT_LOCK_DIR also coalesces identical calls across gunicorn
+# workers. The waiting workers read the result from the shared on-disk cache tier,
+# so it only helps when CACHE_DIR is set as well.
+SINGLE_FLIGHT_LOCK_DIR = os.getenv("SINGLE_FLIGHT_LOCK_DIR")
+
+
+# How often a coroutine waiting for another worker's lock tries it again
+LOCK_POLL_SECONDS = 0.05
+
+
+# Take an exclusive lock on a per-key lock file. The holder deletes the file
+# before unlocking, so a waiter that wakes up on a deleted file tries again.
+# With blocking=False, returns None instead of waiting for the lock.
+def _lock_file(path, blocking=True):
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            os.close(fd)
+            continue
+        if current.st_ino == os.fstat(fd).st_ino:
+            return fd
+        os.close(fd)
+
+def _unlock_file(path, fd):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+# An upstream call that other identical requests are waiting on
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# The same for coroutines: the call runs as its own task, so it only stops
+# when every request waiting on it has gone away
+class AsyncFlight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+# Runs one upstream call per key at a time. Concurrent callers with the same key
+# wait for the first caller's result instead of making their own call.
+class SingleFlight:
+    def __init__(self, lock_dir=SINGLE_FLIGHT_LOCK_DIR):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self._flights = {}
+        self._async_flights = {}
+        self._lock = threading.Lock()
+        self.counters = {'leaders': 0, 'coalesced': 0, 'cross_worker': 0}
+
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    # Call fn() once for all concurrent callers with this key.
+    # recheck() is called under the cross-worker lock and can return a result
+    # another worker already produced.
+    # Returns the result and whether it came from another caller.
+    def do(self, key, fn, recheck=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.counters['leaders'] += 1
+            else:
+                self.counters['coalesced'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result, shared = self._run_leader(key, fn, recheck)
+            return flight.result, shared
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    # Same as do() for coroutines on the event loop
+    async def do_async(self, key, fn, recheck=None):
+        flight = self._async_flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._async_flights[key] = AsyncFlight(asyncio.ensure_future(self._run_leader_async(key, fn, recheck)))
+            flight.task.add_done_callback(lambda task: self._finish_async_flight(key, flight))
+            with self._lock:
+                self.counters['leaders'] += 1
+        else:
+            with self._lock:
+                self.counters['coalesced'] += 1
+
+        flight.waiters += 1
+        try:
+            # Shield so a caller going away (leader included) doesn't cancel the shared call
+            result, shared = await asyncio.shield(flight.task)
+            return result, shared or not leader
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def _finish_async_flight(self, key, flight):
+        if self._async_flights.get(key) is flight:
+            del self._async_flights[key]
+        # Mark the exception as retrieved in case nobody was waiting
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['in_flight'] = len(self._flights) + len(self._async_flights)
+        stats['cross_worker_enabled'] = bool(self.lock_dir)
+        return stats
+
+    def _lock_path(self, key):
+        return os.path.join(self.lock_dir, key + '.lock')
+
+    def _run_leader(self, key, fn, recheck):
+        if not self.lock_dir:
+            return fn(), False
+
+        path = self._lock_path(key)
+        fd = _lock_file(path)
+        try:
+            result = self._recheck(recheck)
+            if result is not None:
+                return result, True
+            return fn(), False
+        finally:
+            _unlock_file(path, fd)
+
+    async def _run_leader_async(self, key, fn, recheck):
+        if not self.lock_dir:
+            return await fn(), False
+
+        # Poll the lock rather than block a thread on flock, so a cancelled
+        # wait can never leave the lock held by nobody
+        path = self._lock_path(key)
+        fd = _lock_file(path, blocking=False)
+        while fd is None:
+            await asyncio.sleep(LOCK_POLL_SECONDS)
+            fd = _lock_file(path, blocking=False)
+        try:
+            # recheck() reads the on-disk cache, so keep it off the event loop
+            result = await asyncio.get_running_loop().run_in_executor(None, self._recheck, recheck)
+            if result is not None:
+                return result, True
+            return await fn(), False
+        finally:
+            _unlock_file(path, fd)
+
+    def _recheck(self, recheck):
+        if recheck is None:
+            return None
+        result = recheck()
+        if result is not None:
+            with self._lock:
+                self.counters['cross_worker'] += 1
+        return result
+
+
+# Shared instance for this worker
+single_flight = SingleFlight()
@@ -0,0 +1,109 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from salary_model import MODEL_ARTEFACT_PATH, LinearModel, publish_model, save_artefact
+
+# Out-of-core trainer for the salary model. Reads the CSV in chunks and keeps
+# only the sufficient statistics (X'X, X'y, y'y) for the training and holdout
+# rows, so memory stays the same however big the file gets. The fit is the
+# same least-squares solution LinearRegression finds.
+#
+# Run with: python streaming_trainer.py --data ./data/Data.csv --chunk-rows 1000000
+
+FEATURE_COLUMNS = ['Age', 'Weight']
+TARGET_COLUMN = 'Salary'
+
+
+# Running X'X, X'y and y'y for a set of rows. X has a leading column of ones
+# for the intercept.
+class SufficientStats:
+    def __init__(self, n_features):
+        self.xtx = np.zeros((n_features + 1, n_features + 1))
+        self.xty = np.zeros(n_features + 1)
+        self.yty = 0.0
+        self.rows = 0
+
+    def add(self, X, y):
+        X = np.column_stack([np.ones(len(X)), X])
+        self.xtx += X.T @ X
+        self.xty += X.T @ y
+        self.yty += float(y @ y)
+        self.rows += len(y)
+
+    # Least-squares weights (intercept first). lstsq copes with a singular X'X,
+    # e.g. a constant column, the same way LinearRegression does.
+    def solve(self):
+        return np.linalg.lstsq(self.xtx, self.xty, rcond=None)[0]
+
+    # Mean squared error of the weights on these rows, without another pass:
+    # |y - Xw|^2 = y'y - 2w'X'y + w'X'Xw
+    def mse(self, weights):
+        if self.rows == 0:
+            return None
+        sse = self.yty - 2 * weights @ self.xty + weights @ self.xtx @ weights
+        return max(float(sse), 0.0) / self.rows
+
+
+# Deterministic holdout membership from the row number alone (splitmix64 of
+# seed + row), so the split needs no shuffle of the whole file and is the same
+# on every run and any chunk size
+def holdout_mask(row_numbers, test_size, seed):
+    with np.errstate(over='ignore'):
+        z = row_numbers.astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53) < test_size
+
+
+def train(path, chunk_rows=1000000, test_size=0.2, seed=42):
+    train_stats = SufficientStats(len(FEATURE_COLUMNS))
+    test_stats = SufficientStats(len(FEATURE_COLUMNS))
+    row = 0
+    chunks = pd.read_csv(path, usecols=FEATURE_COLUMNS + [TARGET_COLUMN], dtype=np.float64, chunksize=chunk_rows)
+    for chunk in chunks:
+        X = chunk[FEATURE_COLUMNS].to_numpy()
+        y = chunk[TARGET_COLUMN].to_numpy()
+        holdout = holdout_mask(np.arange(row, row + len(chunk)), test_size, seed)
+        train_stats.add(X[~holdout], y[~holdout])
+        test_stats.add(X[holdout], y[holdout])
+        row += len(chunk)
+
+    if train_stats.rows == 0:
+        raise ValueError("%s has no training rows" % path)
+    weights = train_stats.solve()
+    model = LinearModel(weights[1:], weights[0], [name.lower() for name in FEATURE_COLUMNS])
+    return model, train_stats, test_stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the salary model from a CSV of any size")
+    parser.add_argument('--data', default='./data/Data.csv', help="CSV with Age, Weight and Salary columns (.gz is fine)")
+    parser.add_argument('--chunk-rows', type=int, default=1000000, help="rows read per chunk")
+    parser.add_argument('--test-size', type=float, default=0.2, help="fraction of rows held out for the MSE")
+    parser.add_argument('--seed', type=int, default=42, help="seed for the holdout split")
+    parser.add_argument('--output', default=MODEL_ARTEFACT_PATH, help="where to write the model artefact")
+    parser.add_argument('--no-export', action='store_true', help="only report the fit, don't write or publish the model")
+    args = parser.parse_args()
+
+    model, train_stats, test_stats = train(args.data, args.chunk_rows, args.test_size, args.seed)
+    print("Rows: %d train, %d holdout" % (train_stats.rows, test_stats.rows))
+    print("Coefficients:", dict(zip(model.features, model.coef.tolist())), "Intercept:", model.intercept)
+    weights = np.concatenate([[model.intercept], model.coef])
+    if test_stats.rows:
+        mse = test_stats.mse(weights)
+        print("Mean Squared Error:", mse)
+    else:
+        mse = train_stats.mse(weights)
+        print("Mean Squared Error: no holdout rows, training MSE", mse)
+
+    if not args.no_export:
+        save_artefact(model, args.output)
+        print("Exported", args.output)
+        version = publish_model(
+            model, mse=mse, rows=train_stats.rows + test_stats.rows, train_rows=train_stats.rows,
+            holdout_rows=test_stats.rows, trained_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            trainer='streaming_trainer.py', data=args.data,
+        )
+        print("Published model version", version)
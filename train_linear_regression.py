@@ -1,14 +1,13 @@
+import time
 import numpy as np
-import pandas as pd
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
+from dataset import load_salary_data
+from salary_model import MODEL_ARTEFACT_PATH, from_sklearn, load_artefact, publish_model, save_artefact
 
-# Load the data from CSV file
-data = pd.read_csv('./data/Data.csv')
-
-# Extract input features (Age and Weight) and target variable (Salary)
-X = data[['Age', 'Weight']]
-y = data['Salary']
+# Load the input features (Age and Weight) and target variable (Salary) from
+# the CSV, through the columnar cache so it is only parsed when it changes
+X, y = load_salary_data('./data/Data.csv')
 
 # Split the data into training and testing sets
 X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
@@ -31,3 +30,21 @@ print("Mean Squared Error:", mse)
 import joblib
 # Save the trained model
 joblib.dump(model, 'trained_model.pkl')
+
+# Export the numpy-only artefact the backend serves from
+save_artefact(from_sklearn(model), MODEL_ARTEFACT_PATH)
+
+# Parity check: the artefact must score exactly like the sklearn model
+artefact_pred = load_artefact(MODEL_ARTEFACT_PATH).predict(X_test)
+max_diff = float(np.max(np.abs(artefact_pred - y_pred)))
+print("Artefact max abs difference:", max_diff)
+if not np.allclose(artefact_pred, y_pred, rtol=1e-9, atol=1e-6):
+    raise SystemExit("Exported artefact does not match the sklearn model")
+print("Exported", MODEL_ARTEFACT_PATH)
+
+# Publish it to the model registry; running workers pick it up on their next request
+version = publish_model(
+    from_sklearn(model), mse=mse, rows=len(y), train_rows=len(X_train), holdout_rows=len(X_test),
+    trained_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), trainer='train_linear_regression.py',
+)
+print("Published model version", version)
@@ -0,0 +1,375 @@
+import asyncio
+import itertools
+import os
+import random
+import threading
+import time
+import aiohttp
+import openai
+import openai.api_requestor
+import requests
+from dotenv import load_dotenv
+
+# Load the .env file
+load_dotenv()
+
+# Upstream settings (can be overridden in the .env file)
+# Keep-alive connections each worker keeps open to the OpenAI API
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))
+# Default per-call timeout in seconds; routes can set their own
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "20"))
+# Seconds a call may spend on all its attempts and waits; keep it under the
+# gunicorn worker timeout. A route timeout longer than this still gets one attempt.
+UPSTREAM_RETRY_BUDGET = float(os.getenv("UPSTREAM_RETRY_BUDGET", "25"))
+# Consecutive failed calls that open the circuit, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "30"))
+
+# Shortest time left in the budget worth starting another attempt with
+MIN_ATTEMPT_SECONDS = 1.0
+
+# Errors worth retrying: rate limits, overload, 5xx and network problems
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+)
+
+
+# Raised when the upstream call failed for good; the routes answer 502/503 with it
+class UpstreamError(Exception):
+    def __init__(self, message, status=503, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+# Raised without calling upstream while the circuit breaker is open
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+# Network errors the openai client lets through unwrapped
+NETWORK_ERRORS = (
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+    requests.RequestException,
+)
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS + NETWORK_ERRORS):
+        return True
+    # Generic API errors are only retried for 5xx responses
+    return isinstance(error, openai.error.APIError) and (error.http_status or 500) >= 500
+
+# Seconds the API asked us to wait, from the Retry-After header
+def retry_after_seconds(error):
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+# Jittered exponential backoff that never waits less than Retry-After
+def backoff_delay(attempt, retry_after=None):
+    delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+# Stops calling upstream after repeated failures, then lets one trial call
+# through once the cooldown has passed (half-open)
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            retry_after = max(self.cooldown - (time.monotonic() - self.opened_at), 1.0)
+        raise CircuitOpenError("OpenAI API is unavailable, try again shortly", retry_after=retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    # The trial call ended without an answer either way (e.g. it was cancelled),
+    # so let the next call be the trial
+    def release_trial(self):
+        with self._lock:
+            self.trial_in_flight = False
+
+
+# Wraps openai.ChatCompletion with a pooled keep-alive session, per-call
+# timeouts, retries with backoff within a total budget and a circuit breaker
+class UpstreamClient:
+    def __init__(self, pool_size=UPSTREAM_POOL_SIZE, max_retries=UPSTREAM_MAX_RETRIES, retry_budget=UPSTREAM_RETRY_BUDGET):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.breaker = CircuitBreaker()
+        self.counters = {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._session = None
+        self._aiosessions = {}
+        self._lock = threading.Lock()
+
+        # openai 0.27 builds one requests.Session per thread through this hook;
+        # hand every thread the same bounded pool instead
+        openai.api_requestor._make_session = self.session
+
+    # Shared requests session, created lazily so each gunicorn worker gets its own after fork
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, pool_block=True,
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    # aiohttp session for the current event loop, used by the async client
+    def aiosession(self):
+        loop = asyncio.get_running_loop()
+        session = self._aiosessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            session = aiohttp.ClientSession(connector=connector)
+            self._aiosessions[loop] = session
+        return session
+
+    async def close_aiosessions(self):
+        loop = asyncio.get_running_loop()
+        session = self._aiosessions.pop(loop, None)
+        if session is not None:
+            await session.close()
+
+    # Streamed calls (stream=True) return the chunks, checked as they are
+    # read: the call only counts as done, for the breaker and the in-flight
+    # count, once the stream has ended
+    def create(self, timeout=None, **params):
+        timeout = timeout or UPSTREAM_TIMEOUT
+        deadline = time.monotonic() + max(self.retry_budget, timeout)
+        streaming = bool(params.get('stream'))
+        attempt = 0
+        while True:
+            self._before_call()
+            delay = None
+            opened = False
+            try:
+                response = openai.ChatCompletion.create(request_timeout=min(timeout, deadline - time.monotonic()), **params)
+                opened = True
+            except Exception as e:
+                delay = self._after_error(e, attempt, deadline)
+            except BaseException:
+                # Cancelled, e.g. the client went away: don't hold the half-open trial
+                self.breaker.release_trial()
+                raise
+            finally:
+                if not (opened and streaming):
+                    self._release()
+
+            if delay is None:
+                if streaming:
+                    return self._stream(response)
+                self.breaker.record_success()
+                return response
+            attempt += 1
+            time.sleep(delay)
+
+    async def acreate(self, timeout=None, **params):
+        # openai 0.27 reads the aiohttp session from a context variable
+        openai.aiosession.set(self.aiosession())
+        timeout = timeout or UPSTREAM_TIMEOUT
+        deadline = time.monotonic() + max(self.retry_budget, timeout)
+        streaming = bool(params.get('stream'))
+        attempt = 0
+        while True:
+            self._before_call()
+            delay = None
+            opened = False
+            try:
+                response = await openai.ChatCompletion.acreate(request_timeout=min(timeout, deadline - time.monotonic()), **params)
+                opened = True
+            except Exception as e:
+                delay = self._after_error(e, attempt, deadline)
+            except BaseException:
+                # Cancelled, e.g. the client went away: don't hold the half-open trial
+                self.breaker.release_trial()
+                raise
+            finally:
+                if not (opened and streaming):
+                    self._release()
+
+            if delay is None:
+                if streaming:
+                    return await self._stream_async(response)
+                self.breaker.record_success()
+                return response
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['in_flight'] = self.in_flight
+            stats['peak_in_flight'] = self.peak_in_flight
+        stats['pool_size'] = self.pool_size
+        stats['pool_utilisation'] = round(stats['in_flight'] / self.pool_size, 3)
+        stats['connections_opened'] = self._connections_opened()
+        stats['circuit'] = self.breaker.state
+        return stats
+
+    def _before_call(self):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            with self._lock:
+                self.counters['rejected'] += 1
+            raise
+        with self._lock:
+            self.counters['calls'] += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    # The first chunk is read here, so a stream that fails straight away
+    # raises before the response starts. The rest are read by the caller.
+    def _stream(self, chunks):
+        stream = self._watch_stream(chunks)
+        try:
+            first = next(stream)
+        except StopIteration:
+            return iter(())
+        return itertools.chain((first,), stream)
+
+    def _watch_stream(self, chunks):
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            # Too late to retry: the caller has already sent part of the answer
+            self._after_error(e, self.max_retries, 0)
+        except BaseException:
+            # Closed early, e.g. the client went away
+            self.breaker.release_trial()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self._release()
+
+    async def _stream_async(self, chunks):
+        stream = self._watch_stream_async(chunks)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        return self._prepend_async(first, stream)
+
+    async def _prepend_async(self, first, stream):
+        if first is None:
+            return
+        try:
+            yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    async def _watch_stream_async(self, chunks):
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            self._after_error(e, self.max_retries, 0)
+        except BaseException:
+            self.breaker.release_trial()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self._release()
+
+    # Decide what to do after a failed call: returns the delay before the next
+    # attempt, or raises UpstreamError once retries are used up or the next
+    # attempt wouldn't start before the deadline
+    def _after_error(self, error, attempt, deadline):
+        retryable = is_retryable(error)
+        retry_after = retry_after_seconds(error)
+        # A failed half-open trial reopens the circuit straight away
+        if retryable and attempt < self.max_retries and self.breaker.state == 'closed':
+            delay = backoff_delay(attempt, retry_after)
+            if time.monotonic() + delay + MIN_ATTEMPT_SECONDS <= deadline:
+                with self._lock:
+                    self.counters['retries'] += 1
+                return delay
+
+        with self._lock:
+            self.counters['failures'] += 1
+        print("OpenAI API call failed: %s" % error)
+        if isinstance(error, openai.error.RateLimitError):
+            # Pass the wait on to the client instead of holding the worker
+            self.breaker.record_failure()
+            raise UpstreamError("Too many requests to the OpenAI API, try again shortly", 429, retry_after or 1.0) from error
+        if retryable:
+            self.breaker.record_failure()
+            raise UpstreamError("OpenAI API is unavailable, try again shortly", 503, retry_after) from error
+        # Bad requests are not an upstream outage, so they don't trip the breaker
+        if isinstance(error, openai.error.OpenAIError):
+            self.breaker.record_success()
+            raise UpstreamError("OpenAI API rejected the request: %s" % error, 502) from error
+        # Anything else unexpected counts against the breaker like an outage
+        self.breaker.record_failure()
+        raise UpstreamError("OpenAI API call failed", 503) from error
+
+    def _connections_opened(self):
+        if self._session is None:
+            return 0
+        pools = self._session.get_adapter('https://').poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+
+# Shared client for this worker
+upstream = UpstreamClient()